@@ -0,0 +1,147 @@
+from __future__ import annotations
+import logging
+import os
+import shutil
+import threading
+
+
+class DiskSpaceMonitor:
+	"""
+	Tracks the disk space reserved by the active downloads on the temporary and final volumes of each host,
+	so that a file is admitted only when its expected size fits in the free space.
+	A reservation shrinks while the download progresses, as its bytes are written on disk.
+	"""
+
+	def __init__(self, dm: 'DownloaderManager', logging_handler: 'logging', margin: int):
+		"""
+		:param dm: The downloader manager, used to find the directories of each host
+		:param logging_handler: The logger
+		:param margin: The bytes always left free on each volume
+		"""
+		self.dm = dm
+		self.logging = logging_handler
+		self.margin = margin
+		self.lock = threading.Lock()
+		# Host -> device -> a directory on the device
+		self.hostDevices = {}
+		# Url -> [devices, expected size, bytes still to be written]
+		self.reservations = {}
+		self.refused = 0
+
+	def fits(self, host: str, size: int, url: str = None) -> bool:
+		"""
+		Check if a file fits in the free space of the volumes used by its host
+		:param host: The host of the file
+		:param size: The bytes that will be written, 0 if unknown
+		:param url: The url of the file, its current reservation is not counted
+		:return: True if every volume has enough free space
+		"""
+		devices = self._get_devices(host)
+		with self.lock:
+			for device, path in devices.items():
+				if self._get_available(device, path, url) < size:
+					return False
+			return True
+
+	def reserve(self, url: str, host: str, size: int) -> bool:
+		"""
+		Reserve the space of a file if it fits, replacing its previous reservation
+		:param url: The url of the file
+		:param host: The host of the file
+		:param size: The bytes that will be written
+		:return: False if the file does not fit, its previous reservation is kept
+		"""
+		devices = self._get_devices(host)
+		with self.lock:
+			for device, path in devices.items():
+				if self._get_available(device, path, url) < size:
+					self.refused += 1
+					self.logging.warning("Not enough space on [" + path + "] for " + str(size) + " bytes [" + url + "]")
+					return False
+			self.reservations[url] = [devices, size, size]
+			return True
+
+	def hold(self, url: str, host: str, size: int):
+		"""
+		Reserve the space of a file already admitted, without checking the free space
+		:param url: The url of the file
+		:param host: The host of the file
+		:param size: The bytes that will be written
+		:return:
+		"""
+		devices = self._get_devices(host)
+		with self.lock:
+			self.reservations[url] = [devices, size, size]
+
+	def progress(self, url: str, percentage: float):
+		"""
+		Reduce the reservation of a file by the part already written
+		:param url: The url of the file
+		:param percentage: The download percentage
+		:return:
+		"""
+		with self.lock:
+			reservation = self.reservations.get(url)
+			if reservation and percentage is not None:
+				reservation[2] = min(reservation[2], max(0, int(reservation[1] * (100 - percentage) / 100)))
+
+	def release(self, url: str):
+		with self.lock:
+			self.reservations.pop(url, None)
+
+	def _get_available(self, device: int, path: str, exclude: str = None) -> int:
+		"""
+		Compute the free space of a device not yet reserved - Must be called holding the lock
+		:param device: The device
+		:param path: A directory on the device
+		:param exclude: The url whose reservation is not counted
+		:return: The bytes available for a new file
+		"""
+		reserved = sum(remaining for url, (devices, size, remaining) in self.reservations.items() if device in devices and url != exclude)
+		return shutil.disk_usage(path).free - reserved - self.margin
+
+	def _get_devices(self, host: str) -> dict:
+		"""
+		Find the volumes where the files of a host are written, caching the settings lookup
+		:param host: The host
+		:return: The devices associated to a directory on each of them
+		"""
+		if host not in self.hostDevices:
+			devices = {}
+			if host is not None:
+				sectionName = self.dm.extractSettingsAssociation(host)['settingsSectionName']
+				for setting in ['tempDir', 'outtmpl']:
+					directory = self._get_existing_dir(self.dm.get_optional_config(sectionName, setting, None))
+					if directory:
+						devices.setdefault(os.stat(directory).st_dev, directory)
+			self.hostDevices[host] = devices
+		return self.hostDevices[host]
+
+	@staticmethod
+	def _get_existing_dir(path: str) -> str:
+		"""
+		Find the directory of a setting, or its nearest existing parent
+		:param path: A directory or an output template
+		:return: The existing directory. None if the path is not set
+		"""
+		if not path:
+			return None
+		directory = os.path.abspath(os.path.dirname(path) if '%' in os.path.basename(path) or not os.path.isdir(path) else path)
+		while not os.path.isdir(directory):
+			directory = os.path.dirname(directory)
+		return directory
+
+	def get_metrics(self) -> dict:
+		with self.lock:
+			volumes = {}
+			for devices in self.hostDevices.values():
+				for device, path in devices.items():
+					if device not in volumes:
+						reserved = sum(remaining for reservedDevices, size, remaining in self.reservations.values() if device in reservedDevices)
+						volumes[device] = {'path': path, 'free': shutil.disk_usage(path).free, 'reserved': reserved}
+			return {
+				'margin': self.margin,
+				'reservations': len(self.reservations),
+				'refused': self.refused,
+				'volumes': list(volumes.values())
+			}
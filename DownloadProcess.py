@@ -0,0 +1,189 @@
+from __future__ import annotations
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from DownloadRecord import DownloadRecord
+from Downloaders.GenericDownloader import StopDownload
+
+# The downloader, its settings and the bridge are inherited by the child, not pickled
+context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+
+OUTCOME_COMPLETE = "complete"
+OUTCOME_PAUSE = "pause"
+OUTCOME_FAIL = "fail"
+OUTCOME_FINALIZE = "finalize"
+OUTCOME_DEFER = "defer"
+MESSAGE_PARTIAL = "partial"
+MESSAGE_RESERVE = "reserve"
+
+
+class ProcessDownload:
+	"""
+	A download running in a child process, registered in the manager in place of the downloader
+	"""
+
+	def __init__(self, process: multiprocessing.Process, logging_handler: 'logging'):
+		self.process = process
+		self.logging = logging_handler
+
+	def stop_download(self):
+		"""
+		Ask the child process to pause the download
+		:return:
+		"""
+		if self.process.is_alive():
+			self.logging.info("Sending pause signal to download process [" + str(self.process.pid) + "]")
+			os.kill(self.process.pid, signal.SIGUSR1)
+
+
+class ProcessBridge:
+	"""
+	Replaces the manager inside the child process: the progress is written to shared memory, the resume state and the outcome are sent to the parent,
+	that also decides the disk space reservations.
+	Built by the parent before the fork with the values the child needs: the locks of the manager may be held by another thread
+	while forking, so the child must never use the manager, its queues or its caches.
+	"""
+
+	def __init__(self, dm: 'DownloaderManager', file: DownloadRecord, progress: multiprocessing.Value, connection):
+		self.progress = progress
+		self.connection = connection
+		# The segments of a download report their state concurrently
+		self.lock = threading.Lock()
+		# Reads only the settings, never modified while running
+		self.get_optional_config = dm.get_optional_config
+		self.httpPool = dm.httpPool
+		# A private copy, so that the child does not share the lock of the manager cache
+		self.metadataCache = dm.metadataCache.copy()
+		self.sourceQueue = dm.locate_download(file)
+
+	def locate_download(self, file: DownloadRecord) -> str:
+		return self.sourceQueue
+
+	def registerDownloader(self, url: str, downloader) -> int:
+		return 0
+
+	def unregisterDownloader(self, url: str):
+		pass
+
+	def update_download_progress(self, downloadId: int, percentage: float):
+		self.progress.value = percentage
+
+	def save_download_state(self, file: DownloadRecord, partial: dict):
+		self._send(MESSAGE_PARTIAL, partial)
+
+	def reserve_disk_space(self, file: DownloadRecord, size: int) -> bool:
+		# Only the parent knows the current reservations of every download
+		with self.lock:
+			self.connection.send((MESSAGE_RESERVE, size))
+			return self.connection.recv()
+
+	def defer_this_download(self, file: DownloadRecord):
+		self._send(OUTCOME_DEFER, None)
+
+	def post_process_this_download(self, file: DownloadRecord, job: callable, finalize: callable):
+		# The post processing cannot be handed to the parent, it runs in the child and is stopped by a pause
+		finalize(file, job(lambda: self._check_stop(file)))
+
+	@staticmethod
+	def _check_stop(file: DownloadRecord):
+		if file.stop:
+			raise StopDownload("Stopping post processing [" + file.url + "]")
+
+	def finalize_this_download(self, file: DownloadRecord, source: str, destination: str, source_queue: str = None):
+		# The file is moved by the parent, so that a copy to another device does not keep the child alive
+		self._send(OUTCOME_FINALIZE, (source, destination))
+
+	def complete_this_download(self, file: DownloadRecord, source_queue: str = None):
+		self._send(OUTCOME_COMPLETE, None)
+
+	def pause_this_download(self, file: DownloadRecord):
+		self._send(OUTCOME_PAUSE, None)
+
+	def fail_this_download(self, file: DownloadRecord, source_queue: str = None):
+		self._send(OUTCOME_FAIL, None)
+
+	def _send(self, message: str, value):
+		with self.lock:
+			self.connection.send((message, value))
+
+
+def run_in_process(dm: 'DownloaderManager', downloader, file: DownloadRecord, logging_handler: 'logging', pollInterval: float):
+	"""
+	Download a file in a child process, reporting its progress and outcome to the manager like a local download
+	:param dm: The downloader manager
+	:param downloader: The downloader, already prepared with process_download
+	:param file: The file to download
+	:param logging_handler: The logger
+	:param pollInterval: The seconds between two progress reports
+	:return:
+	"""
+	progress = context.Value('d', -1.0, lock=False)
+	# Duplex: the child waits for the answer to its disk space reservations
+	connection, childConnection = context.Pipe()
+	bridge = ProcessBridge(dm, file, progress, childConnection)
+	process = context.Process(target=_child_main, args=(downloader, file, bridge), daemon=True, name="download-process")
+	# The child inherits the blocked signal, so a pause requested before its handler is installed is not lost
+	signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR1})
+	try:
+		process.start()
+	finally:
+		signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGUSR1})
+	childConnection.close()
+	downloadId = dm.registerDownloader(file.url, ProcessDownload(process, logging_handler))
+	logging_handler.info("Started download process [" + str(process.pid) + "] for " + file.url)
+	lastProgress = None
+	outcome = OUTCOME_FAIL
+	result = None
+	try:
+		while True:
+			ready = connection.poll(pollInterval)
+			if progress.value >= 0 and progress.value != lastProgress:
+				lastProgress = progress.value
+				dm.update_download_progress(downloadId, lastProgress)
+			if ready:
+				message, value = connection.recv()
+				if message == MESSAGE_PARTIAL:
+					dm.save_download_state(file, value)
+					continue
+				if message == MESSAGE_RESERVE:
+					connection.send(dm.reserve_disk_space(file, value))
+					continue
+				outcome = message
+				result = value
+				break
+	except (EOFError, BrokenPipeError):
+		logging_handler.error("Download process [" + str(process.pid) + "] ended without outcome - Exit code: " + str(process.exitcode))
+	finally:
+		connection.close()
+		process.join()
+	if outcome == OUTCOME_COMPLETE:
+		dm.complete_this_download(file)
+	elif outcome == OUTCOME_FINALIZE:
+		dm.finalize_this_download(file, *result)
+	elif outcome == OUTCOME_PAUSE:
+		dm.pause_this_download(file)
+	elif outcome == OUTCOME_DEFER:
+		dm.defer_this_download(file)
+	else:
+		dm.fail_this_download(file)
+
+
+def _child_main(downloader, file: DownloadRecord, bridge: ProcessBridge):
+	"""
+	Entry point of the child process
+	:return:
+	"""
+	downloader.download_manager = bridge
+	bridge.httpPool.after_fork()
+
+	def request_pause(signum, frame):
+		file.stop = True
+
+	signal.signal(signal.SIGUSR1, request_pause)
+	signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGUSR1})
+	try:
+		downloader.run()
+	finally:
+		bridge.connection.close()
@@ -0,0 +1,58 @@
+from __future__ import annotations
+import sys
+
+
+class DownloadRecord:
+	"""
+	A file managed by the downloader, stored in the queues and in the history
+	"""
+
+	__slots__ = ('url', 'name', 'host', 'status', 'stop', 'resolved', 'requestId', 'partial', 'size')
+
+	def __init__(self, url: str, name: str = None, host: str = None, status: float = None, resolved: bool = True, requestId: str = None, partial: dict = None, size: int = None):
+		self.url = url
+		self.name = name
+		# Many records share the same few hosts
+		self.host = sys.intern(host) if host else None
+		# The download percentage
+		self.status = status
+		# Runtime flag used to request the download to stop, never stored
+		self.stop = False
+		# False for a requested url not yet resolved into the files to download
+		self.resolved = resolved
+		# The id returned to the client requesting an url
+		self.requestId = requestId
+		# The partially downloaded file used to resume the download (location, validators and downloaded ranges)
+		self.partial = partial
+		# The bytes the download writes on disk, once known. Used to admit the file only when it fits
+		self.size = size
+
+	@classmethod
+	def from_dict(cls, values: dict) -> DownloadRecord:
+		"""
+		Create a record from its dictionary representation
+		:param values: The dictionary containing at least the url
+		:return: The record
+		"""
+		return cls(values['url'], values.get('name'), values.get('host'), values.get('status'), values.get('resolved', True), values.get('requestId'), values.get('partial'), values.get('size'))
+
+	def to_dict(self) -> dict:
+		"""
+		Create the dictionary representation of the record, ready to be serialized
+		:return: The dictionary containing the stored fields
+		"""
+		values = {'url': self.url, 'name': self.name, 'host': self.host}
+		if self.status is not None:
+			values['status'] = self.status
+		if not self.resolved:
+			values['resolved'] = False
+		if self.requestId is not None:
+			values['requestId'] = self.requestId
+		if self.partial is not None:
+			values['partial'] = self.partial
+		if self.size is not None:
+			values['size'] = self.size
+		return values
+
+	def __repr__(self) -> str:
+		return "DownloadRecord(" + str(self.to_dict()) + ")"
@@ -0,0 +1,125 @@
+from __future__ import annotations
+import logging
+import threading
+import time
+import DownloadProcess
+from DownloadRecord import DownloadRecord
+
+
+class DownloadWorkerPool:
+	"""
+	A fixed set of long-lived workers that pull the files to download from the scheduler.
+	Each worker keeps one downloader instance for each downloader class, reused for all its downloads.
+	In process mode each download runs in a child process, supervised by its worker.
+	"""
+
+	MODE_THREAD = "thread"
+	MODE_PROCESS = "process"
+
+	def __init__(self, dm: 'DownloaderManager', logging_handler: 'logging', size: int, executionMode: str = MODE_THREAD):
+		self.dm = dm
+		self.logging = logging_handler
+		self.size = max(1, size)
+		if executionMode == self.MODE_PROCESS and DownloadProcess.context is None:
+			self.logging.warning("Process execution mode is not supported on this platform - Using " + self.MODE_THREAD)
+			executionMode = self.MODE_THREAD
+		elif executionMode not in [self.MODE_THREAD, self.MODE_PROCESS]:
+			self.logging.warning("Unknown execution mode [" + str(executionMode) + "] - Using " + self.MODE_THREAD)
+			executionMode = self.MODE_THREAD
+		self.executionMode = executionMode
+		self.workers = []
+		self.lock = threading.Lock()
+		self.busyWorkers = 0
+		self.dispatched = 0
+		self.downloaderInstances = 0
+		self.totalDispatchLatency = 0.0
+		self.maxDispatchLatency = 0.0
+
+	def start(self):
+		"""
+		Start the workers
+		:return:
+		"""
+		for idx in range(self.size):
+			worker = threading.Thread(target=self._work, name="download-" + str(idx), daemon=True)
+			self.workers.append(worker)
+			worker.start()
+		self.logging.info("Started " + str(self.size) + " download workers")
+
+	def join(self):
+		for worker in self.workers:
+			worker.join()
+
+	def _work(self):
+		"""
+		Download the available files, one at a time
+		:return:
+		"""
+		downloaders = {}
+		while True:
+			file = self.dm.queueManager.get_next_file()
+			if file is None:
+				self.logging.info("Received invalid download file, ignoring it")
+				continue
+			pickedAt = time.perf_counter()
+			try:
+				downloader = self._get_downloader(downloaders, file)
+			except BaseException as e:
+				self.logging.error("Cannot create the downloader of " + file.url + " [" + str(e) + "]")
+				self.dm.fail_this_download(file)
+				continue
+			downloader.process_download(file)
+			self._dispatched(time.perf_counter() - pickedAt)
+			self.logging.info("Started download of: " + str(file))
+			print("Started download of: " + str(file.name) + "[" + file.url + "]")
+			try:
+				if self.executionMode == self.MODE_PROCESS:
+					DownloadProcess.run_in_process(self.dm, downloader, file, self.logging, self.dm.progressInterval)
+				else:
+					downloader.run()
+			except BaseException as e:
+				self.logging.error("Cannot download " + file.url + " - Unmanaged error [" + str(e) + "]")
+				self.dm.fail_this_download(file)
+			finally:
+				with self.lock:
+					self.busyWorkers -= 1
+
+	def _get_downloader(self, downloaders: dict, file: DownloadRecord):
+		"""
+		Retrieve the downloader of this worker able to manage a file, creating it on first use
+		:param downloaders: The downloaders of the worker, by class
+		:param file: The file to download
+		:return: The downloader instance
+		"""
+		downloaderClass = self.dm.get_downloader_class(file.url)
+		downloader = downloaders.get(downloaderClass)
+		if downloader is None:
+			downloader = downloaderClass(self.dm.configuration, self.logging, self.dm)
+			downloaders[downloaderClass] = downloader
+			with self.lock:
+				self.downloaderInstances += 1
+		return downloader
+
+	def _dispatched(self, latency: float):
+		with self.lock:
+			self.busyWorkers += 1
+			self.dispatched += 1
+			self.totalDispatchLatency += latency
+			self.maxDispatchLatency = max(self.maxDispatchLatency, latency)
+
+	def get_metrics(self) -> dict:
+		"""
+		Retrieve the counters of the pool
+		:return: The workers usage and the latency between picking a file and starting its download, in milliseconds
+		"""
+		with self.lock:
+			return {
+				'executionMode': self.executionMode,
+				'workers': len(self.workers),
+				'aliveWorkers': sum(1 for worker in self.workers if worker.is_alive()),
+				'busyWorkers': self.busyWorkers,
+				'dispatched': self.dispatched,
+				'downloaderInstances': self.downloaderInstances,
+				'averageDispatchLatencyMs': round(self.totalDispatchLatency / self.dispatched * 1000, 3) if self.dispatched else 0,
+				'maxDispatchLatencyMs': round(self.maxDispatchLatency * 1000, 3)
+			}
@@ -1,9 +1,24 @@
 from __future__ import annotations
+import json
 import logging
 import os
+import tempfile
 import threading
+import time
+import uuid
 from urllib.parse import urlparse
 import yaml
+from DownloadRecord import DownloadRecord
+from DiskSpaceMonitor import DiskSpaceMonitor
+from DownloadWorkerPool import DownloadWorkerPool
+from FileMover import FileMover
+from HttpSessionPool import HttpSessionPool
+from PostProcessingPool import PostProcessingPool
+from MetadataCache import MetadataCache
+from ProgressTable import ProgressTable
+from QueueJournal import QueueJournal
+from QueueStore import MemoryQueueStore, SqliteQueueStore
+from UrlResolver import UrlResolver
 from QueueManager import QueueManager
 from IUBBaseTools import IUBConfiguration
 
@@ -37,19 +52,52 @@ class DownloaderManager(threading.Thread):
 	all_settings_dir = "Settings"
 	setting_file = "settings.yml"
 	association_file = "association.yml"
+	history_file = "history.jsonl"
+	legacy_history_file = "history.yml"
+	journal_file = "history.journal"
+	database_file = "history.db"
+
+	BACKEND_MEMORY = "memory"
+	BACKEND_SQLITE = "sqlite"
 
 	def __init__(self, settings: IUBConfiguration, logging_handler: logging):
 		super().__init__()
-		self.queueManager = QueueManager(settings, logging, self)
+		self.logging = logging_handler
+		self.configuration = settings
+		self.queueBackend = self.get_optional_config('GlobalSettings', 'queueBackend', self.BACKEND_MEMORY)
+		# Needed by the queue manager, that finds the download limit of the hosts of the stored files
 		self.downloaderAssociation = self.loadAssociationList()
-		self.registeredDownload = []
+		self.queueManager = QueueManager(settings, logging, self, self.create_queue_store())
+		self.diskSpace = DiskSpaceMonitor(self, self.logging, self.get_optional_config('GlobalSettings', 'minFreeSpace', 0))
+		self.queueManager.attach_disk_space(self.diskSpace, self.get_optional_config('GlobalSettings', 'diskSpaceCheckInterval', 30))
+		# Download id -> registration, the url index allows to find the registration of a file
+		self.registeredDownload = {}
+		self.registeredUrls = {}
 		self.registrationLock = threading.Condition()
+		# A save requested while the background compaction is storing the history waits for it
+		self.historyLock = threading.Lock()
+		# Host -> downloader class
+		self.downloaderClasses = {}
 		self.downloadFailed = []
 		self.inProgress = []
 		self.paused = []
 		self.downloadCompleted = []
-		self.logging = logging_handler
-		self.configuration = settings
+		self.progressTable = ProgressTable(settings.get_config('GlobalSettings', 'maxTotalDownload'))
+		self.progressInterval = self.get_optional_config('GlobalSettings', 'progressInterval', 1)
+		self.workerPool = DownloadWorkerPool(self, self.logging, settings.get_config('GlobalSettings', 'maxTotalDownload'),
+			self.get_optional_config('GlobalSettings', 'executionMode', DownloadWorkerPool.MODE_THREAD))
+		self.metadataCache = MetadataCache(self.logging,
+			self.get_optional_config('GlobalSettings', 'metadataCacheSize', 200),
+			self.get_optional_config('GlobalSettings', 'metadataCacheTTL', 3600),
+			self.get_optional_config('GlobalSettings', 'metadataCacheFile', None))
+		self.metadataCache.load()
+		self.postProcessor = PostProcessingPool(self, self.logging, self.get_optional_config('GlobalSettings', 'maxPostProcessing', 1))
+		self.fileMover = FileMover(self, self.logging, self.get_optional_config('GlobalSettings', 'maxFileMovers', 1))
+		self.httpPool = HttpSessionPool(self.logging, self.get_optional_config('GlobalSettings', 'maxConnectionsPerHost', 8),
+			poolTimeout=self.get_optional_config('GlobalSettings', 'httpPoolTimeout', 120))
+		self.resolver = UrlResolver(self, self.logging,
+			self.get_optional_config('GlobalSettings', 'maxResolvers', 2),
+			self.get_optional_config('GlobalSettings', 'resolverPageSize', 50))
 		print("Downloader Manager successfully started")
 		self.logging.info("Downloader Manager successfully started")
 
@@ -58,28 +106,22 @@ class DownloaderManager(threading.Thread):
 		Start thread that manages url
 		:return:
 		"""
-		while True:
-			# Retrieve the next file to process
-			file = self.queueManager.get_next_file()
-			if file is not None:
-				# Retrieve the downloader to process that link
-				downloader = self.get_downloader(file['url'])
-				downloader.process_download(file)
-				downloader.start()
-				self.logging.info("Started download of: " + str(file))
-				print("Started download of: " + file['name'] + "[" + file['url'] + "]")
-			else:
-				self.logging.info("Received invalid download file, ignoring it")
+		threading.Thread(target=self.publish_download_progress, daemon=True).start()
+		self.workerPool.start()
+		self.workerPool.join()
 
-	def registerDownloader(self, url: str, downloader: GenericDownloader):
+	def registerDownloader(self, url: str, downloader: GenericDownloader) -> int:
 		"""
 		Associate an url to the relative downloader
 		:param url:
 		:param downloader:
-		:return:
+		:return: The download id, used to report the download progress
 		"""
 		with self.registrationLock:
-			self.registeredDownload.append({'url': url, 'downloader': downloader})
+			downloadId = self.progressTable.register(url)
+			self.registeredDownload[downloadId] = {'url': url, 'downloader': downloader, 'downloadId': downloadId}
+			self.registeredUrls[url] = downloadId
+			return downloadId
 
 	def unregisterDownloader(self, url):
 		"""
@@ -88,41 +130,124 @@ class DownloaderManager(threading.Thread):
 		:return:
 		"""
 		with self.registrationLock:
-			for registration in self.registeredDownload:
-				if registration['url'] == url:
-					self.registeredDownload.remove(registration)
+			downloadId = self.registeredUrls.pop(url, None)
+			if downloadId is not None:
+				self.progressTable.release(downloadId)
+				del self.registeredDownload[downloadId]
+
+	def complete_this_download(self, file: DownloadRecord, source_queue: str = QueueManager.DOWNLOAD_ACTIVE):
+		self.unregisterDownloader(file.url)
+		# Nothing left to resume
+		self.queueManager.update_partial(file.url, None)
+		return self.queueManager.change_queue(file.url, source_queue, 'downloadCompleted')
+
+	def finalize_this_download(self, file: DownloadRecord, source: str, destination: str, source_queue: str = QueueManager.DOWNLOAD_ACTIVE):
+		"""
+		Move the downloaded file to its final location and complete the download.
+		A move to another device is a copy, it runs on the mover workers from the post processing queue
+		:param file: The downloaded file
+		:param source: The location of the downloaded file
+		:param destination: The final location of the file
+		:param source_queue: The queue where the file is located
+		:return:
+		"""
+		try:
+			if self.fileMover.rename(source, destination):
+				return self.complete_this_download(file, source_queue)
+		except FileNotFoundError:
+			self.logging.warning('Cannot find downloaded file: ' + source)
+			print('Cannot find file: ' + source)
+			return self.complete_this_download(file, source_queue)
+		self.logging.info("Copying [" + source + "] to another device [" + destination + "]")
+		self.unregisterDownloader(file.url)
+		if source_queue != QueueManager.DOWNLOAD_POSTPROCESSING and not self.queueManager.change_queue(file.url, source_queue, QueueManager.DOWNLOAD_POSTPROCESSING):
+			return False
+		self.fileMover.submit(file, source, destination,
+			lambda: self.complete_this_download(file, QueueManager.DOWNLOAD_POSTPROCESSING),
+			lambda: self.fail_this_download(file, QueueManager.DOWNLOAD_POSTPROCESSING))
+		return True
+
+	def locate_download(self, file: DownloadRecord) -> str:
+		"""
+		Find the queue of a file being downloaded or post processed
+		:param file: The file
+		:return: The queue name. None if the file is no longer in these queues
+		"""
+		return self.queueManager.retrieveFileFromUrl(file.url, [QueueManager.DOWNLOAD_ACTIVE, QueueManager.DOWNLOAD_POSTPROCESSING])[1]
+
+	def reserve_disk_space(self, file: DownloadRecord, size: int) -> bool:
+		"""
+		Reserve the disk space still needed by an active download
+		:param file: The downloading file
+		:param size: The bytes that will be written. 0 once they are allocated on disk
+		:return: False if the file does not fit in the free space
+		"""
+		return self.queueManager.reserve_space(file.url, size)
 
-	def complete_this_download(self, file: dict):
-		return self.queueManager.change_queue(file["url"], 'inProgress', 'downloadCompleted')
+	def defer_this_download(self, file: DownloadRecord):
+		"""
+		Put back in the download queue a file that does not fit in the free disk space, it is admitted again once it fits
+		:param file: The file to defer
+		:return:
+		"""
+		self.logging.warning("Not enough disk space, download deferred: [" + file.url + "]")
+		print("Not enough disk space, download deferred: [" + file.url + "]")
+		self.unregisterDownloader(file.url)
+		return self.queueManager.change_queue(file.url, QueueManager.DOWNLOAD_ACTIVE, QueueManager.DOWNLOAD_QUEUE)
+
+	def post_process_this_download(self, file: DownloadRecord, job: callable, finalize: callable):
+		"""
+		Hand a downloaded file to the post processing workers, freeing its download slot
+		:param file: The downloaded file
+		:param job: The post processing, called with a stop check and returning the final file name
+		:param finalize: Called with the file and the final file name to complete the download
+		:return:
+		"""
+		self.unregisterDownloader(file.url)
+		if self.queueManager.change_queue(file.url, QueueManager.DOWNLOAD_ACTIVE, QueueManager.DOWNLOAD_POSTPROCESSING):
+			self.postProcessor.submit(file, job, finalize)
 
-	def request_pause_this_download(self, file: dict):
+	def request_pause_this_download(self, file: DownloadRecord):
 		"""
 		Send a request to pause a download
 		:param file:
 		:return:
 		"""
-		for registration in self.registeredDownload:
-			if registration['url'] == file['url']:
-				self.logging.info("Sendind request for pausing this download: " + file['url'])
+		with self.registrationLock:
+			registration = self.registeredDownload.get(self.registeredUrls.get(file.url))
+			if registration:
+				self.logging.info("Sendind request for pausing this download: " + file.url)
+				# Still holding the lock: once unregistered, the downloader can be reused for another file
 				registration['downloader'].stop_download()
 
-	def pause_this_download(self, file: dict):
+	def save_download_state(self, file: DownloadRecord, partial: dict):
+		"""
+		Store the state of a partial download, so that it can be resumed after a pause or a restart
+		:param file: The file being downloaded
+		:param partial: The resume state of the downloader
+		:return:
+		"""
+		self.queueManager.update_partial(file.url, partial)
+
+	def pause_this_download(self, file: DownloadRecord):
 		"""
 		Stop of an active download
 		:param file: The file to stop download
 		:return:
 		"""
-		return self.queueManager.change_queue(file["url"], 'inProgress', 'paused')
+		self.unregisterDownloader(file.url)
+		return self.queueManager.change_queue(file.url, 'inProgress', 'paused')
 
-	def fail_this_download(self, file: dict):
+	def fail_this_download(self, file: DownloadRecord, source_queue: str = QueueManager.DOWNLOAD_ACTIVE):
 		"""
 		Handle all the activities related to the download failure
 		:param file: The file that cannot be downloaded
+		:param source_queue: The queue where the file is located
 		:return:
 		"""
-		self.logging.info("Download failed: [" + file["url"] + "]")
-		self.unregisterDownloader(file["url"])
-		return self.queueManager.change_queue(file["url"], 'inProgress', 'downloadFailed')
+		self.logging.info("Download failed: [" + file.url + "]")
+		self.unregisterDownloader(file.url)
+		return self.queueManager.change_queue(file.url, source_queue, 'downloadFailed')
 
 	def cancel_download(self, url: str) -> bool:
 		"""
@@ -142,60 +267,156 @@ class DownloaderManager(threading.Thread):
 			self.logging.warning("No url to delete received")
 			return False
 
-	def restart_download(self, url: str) -> bool:
+	def restart_download(self, url: str):
 		"""
 		Try to restore the download of an url
-		:param url: The failed url to restore
-		:return: True if the restart was successful, false otherwise
+		:param url: The failed or paused url to restore, a partial download is resumed
+		:return: The queue the url was restored from, None if the restart failed
 		"""
 		if url:
 			self.logging.info("Restarting url: " + str(url))
-			file, queue = self.queueManager.retrieveFileFromUrl(url, [QueueManager.DOWNLOAD_FAILED])
+			file, queue = self.queueManager.retrieveFileFromUrl(url, [QueueManager.DOWNLOAD_FAILED, QueueManager.DOWNLOAD_PAUSED])
+			if file is None:
+				self.logging.warning("No failed or paused download for url: " + str(url))
+				return None
 			self.queueManager.delete_file_from_queue(file, queue)
-			return self.queueManager.addBatchFiles([file])
+			if not file.resolved:
+				# The resolution failed, request the url again
+				restarted = self.request_download(url) is not None
+			else:
+				restarted = self.queueManager.addBatchFiles([file])
+			return queue if restarted else None
 		else:
 			self.logging.warning("No url to delete received")
-			return False
+			return None
 
 	def request_download(self, url: str):
 		"""
-		Add a new url to the list of link to manage
+		Add a new url to the list of link to manage. The url is resolved in background
 		:param url: The url to manage
-		:return:
+		:return: The request id. None if the url is not accepted
 		"""
 		if not isinstance(url, str):
 			self.logging.info("Not a valid link passed")
-			return
+			return None
 		if self.queueManager.already_managing(url):
 			self.logging.info("Already downloading: [" + url + "] - Skip")
-			return
+			return None
 		self.logging.info("Adding new url to download list [" + url + "]")
-		downloader = self.get_downloader(url)
-		el = downloader.get_info(url)
-		if 'dir_value' in el:
-			self.queueManager.addBatchFiles(el['dir_value'])
-		else:
-			self.queueManager.addBatchFiles([el])
+		request = DownloadRecord(url, url, urlparse(url).netloc, resolved=False, requestId=uuid.uuid4().hex)
+		self.queueManager.addBatchFiles([request], QueueManager.DOWNLOAD_RESOLVING)
+		self.resolver.submit(request)
+		return request.requestId
+
+	def resume_resolution(self):
+		"""
+		Resolve again the urls that were waiting for resolution in the previous run
+		:return:
+		"""
+		for request in self.queueManager.get_files(QueueManager.DOWNLOAD_RESOLVING):
+			self.logging.info("Resuming resolution of [" + request.url + "]")
+			self.resolver.submit(request)
 
 	def get_queue(self):
 		return self.queueManager.get_queues()
 
+	def get_queue_snapshot(self):
+		return self.queueManager.get_snapshot()
+
+	def get_queue_events(self, since: int, timeout: float = None):
+		return self.queueManager.get_events(since, timeout)
+
+	def get_queue_page(self, queue: str, offset: int, limit: int):
+		return self.queueManager.get_page(queue, offset, limit)
+
+	def get_queue_counts(self):
+		return self.queueManager.get_counts()
+
+	def create_queue_store(self) -> MemoryQueueStore:
+		"""
+		Create the store containing the queues, according to the selected backend
+		:return: The queue store
+		"""
+		if self.queueBackend == self.BACKEND_SQLITE:
+			path = self.get_optional_config('GlobalSettings', 'databaseFile', self.database_file)
+			return SqliteQueueStore(path, QueueManager.ALL_QUEUES, QueueManager.ACTIVE_QUEUES, self.logging)
+		if self.queueBackend != self.BACKEND_MEMORY:
+			self.logging.warning("Unknown queue backend [" + str(self.queueBackend) + "] - Using " + self.BACKEND_MEMORY)
+			self.queueBackend = self.BACKEND_MEMORY
+		return MemoryQueueStore(QueueManager.ALL_QUEUES)
+
+	def get_metrics(self) -> dict:
+		with self.registrationLock:
+			registered = len(self.registeredDownload)
+		return {
+			'workerPool': self.workerPool.get_metrics(),
+			'postProcessing': self.postProcessor.get_metrics(),
+			'fileMover': self.fileMover.get_metrics(),
+			'diskSpace': self.diskSpace.get_metrics(),
+			'registeredDownloads': registered,
+			'threads': threading.active_count(),
+			'metadataCache': self.metadataCache.get_stats(),
+			'httpPool': self.httpPool.get_stats()
+		}
+
+	def get_downloader_class(self, url: str) -> type:
+		"""
+		Retrieve the downloader class able to manage this file, resolved once for each host
+		:param url: The url to manage
+		:return: The downloader class
+		"""
+		host = urlparse(url).netloc
+		downloaderClass = self.downloaderClasses.get(host)
+		if downloaderClass is None:
+			info = self.extractSettingsAssociation(host)
+			downloaderClass = globals()[info["downloaderName"]]
+			self.downloaderClasses[host] = downloaderClass
+		return downloaderClass
+
 	def get_downloader(self, url: str):
 		"""
 		Dynamically retrieve the downloader to use to manage this file
 		:param url: The url to manage
 		:return: The downloader instance
 		"""
-		host = urlparse(url).netloc
-		info = self.extractSettingsAssociation(host)
-		className = info["downloaderName"]
-		constructor = globals()[className]
+		constructor = self.get_downloader_class(url)
 		instance = constructor(self.configuration, self.logging, self)
-		self.logging.info("Dynamically created an instance of: " + className)
+		self.logging.info("Dynamically created an instance of: " + constructor.__name__)
 		return instance
 
-	def update_download_progress(self, url: str, percentage: float):
-		self.queueManager.update_download_progress(url, percentage)
+	def update_download_progress(self, downloadId: int, percentage: float):
+		"""
+		Report the progress of a download - Does not lock the queues, the progress is published periodically
+		:param downloadId: The id received registering the downloader
+		:param percentage: The current download percentage
+		:return:
+		"""
+		self.progressTable.update(downloadId, percentage)
+
+	def publish_download_progress(self):
+		"""
+		Periodically publish the download progress to the queues
+		:return:
+		"""
+		while True:
+			time.sleep(self.progressInterval)
+			changes = self.progressTable.collect()
+			if changes:
+				self.queueManager.update_download_progress(changes)
+
+	def get_optional_config(self, section: str, key: str, default):
+		"""
+		Retrieve a setting that may be missing from the configuration
+		:param section: The settings section
+		:param key: The setting name
+		:param default: The value to use if the setting is missing
+		:return: The setting value
+		"""
+		try:
+			value = self.configuration.get_config(section, key)
+		except (KeyError, TypeError):
+			value = None
+		return default if value is None else value
 
 	def loadAssociationList(self) -> dict:
 		"""
@@ -249,27 +470,104 @@ class DownloaderManager(threading.Thread):
 
 	def loadHistory(self):
 		"""
-		Load the history from a file populates the different queue
+		Load the history from a file, replay the journal and populates the different queue
 		:return:
 		"""
-		#Load history
-		filename = 'history.yml'
-		if os.path.isfile(filename):
-			with open('history.yml', 'r') as f:
-				rawList = yaml.safe_load(f)
-			#Parse
-			rawList[QueueManager.DOWNLOAD_QUEUE] = rawList[QueueManager.DOWNLOAD_ACTIVE] + rawList[QueueManager.DOWNLOAD_QUEUE]
-			rawList[QueueManager.DOWNLOAD_ACTIVE] = []
-			#Load
-			for queue in rawList:
-				self.queueManager.addBatchFiles(rawList[queue], queue)
+		if self.queueBackend == self.BACKEND_SQLITE:
+			return self.loadDatabase()
+		journal = QueueJournal(self.journal_file, self.logging,
+			self.get_optional_config('GlobalSettings', 'journalFsync', QueueJournal.FSYNC_INTERVAL),
+			self.get_optional_config('GlobalSettings', 'journalFsyncInterval', 1),
+			self.get_optional_config('GlobalSettings', 'journalCompactEvery', 10000))
+		rawList = self.readHistory(journal)
+		#Parse
+		rawList[QueueManager.DOWNLOAD_QUEUE] = rawList.get(QueueManager.DOWNLOAD_ACTIVE, []) + rawList.get(QueueManager.DOWNLOAD_POSTPROCESSING, []) + rawList.get(QueueManager.DOWNLOAD_QUEUE, [])
+		rawList[QueueManager.DOWNLOAD_ACTIVE] = []
+		rawList[QueueManager.DOWNLOAD_POSTPROCESSING] = []
+		#Load
+		self.queueManager.restore({queue: [DownloadRecord.from_dict(file) for file in files] for queue, files in rawList.items()})
+		#Store the recovered state as the new snapshot and start a new journal
+		self.saveHistory()
+		for path in [journal.rotatedPath, journal.path]:
+			if os.path.isfile(path):
+				os.remove(path)
+		journal.open()
+		self.queueManager.attach_journal(journal)
+		self.resume_resolution()
+
+	def readHistory(self, journal: QueueJournal) -> dict:
+		"""
+		Read the history snapshot and replay the changes stored after the snapshot
+		:param journal: The journal of the changes
+		:return: The content of each queue as a list of dictionaries
+		"""
+		rawList = {}
+		if os.path.isfile(self.history_file):
+			# One file for each line, streamed
+			with open(self.history_file, 'r', encoding='utf-8') as f:
+				for line in f:
+					if line.strip():
+						file = json.loads(line)
+						rawList.setdefault(file.pop('queue'), []).append(file)
+		elif os.path.isfile(self.legacy_history_file):
+			self.logging.info("Loading legacy history file [" + self.legacy_history_file + "]")
+			with open(self.legacy_history_file, 'r') as f:
+				rawList = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or {}
 		else:
 			print("No history file found")
+		return QueueJournal.replay(rawList, [journal.rotatedPath, journal.path], self.logging)
+
+	def loadDatabase(self):
+		"""
+		Prepare the queues stored in the database, migrating the history file on the first start
+		:return:
+		"""
+		journal = QueueJournal(self.journal_file, self.logging)
+		historyFiles = [self.history_file, self.legacy_history_file]
+		if self.queueManager.store.is_empty() and any(os.path.isfile(path) for path in historyFiles + [journal.rotatedPath, journal.path]):
+			self.logging.info("Migrating history file to the database")
+			print("Migrating history file to the database")
+			rawList = self.readHistory(journal)
+			self.queueManager.restore({queue: [DownloadRecord.from_dict(file) for file in files] for queue, files in rawList.items()})
+			# Keep the old history as a backup
+			for path in historyFiles:
+				if os.path.isfile(path):
+					os.replace(path, path + ".migrated")
+			for path in [journal.rotatedPath, journal.path]:
+				if os.path.isfile(path):
+					os.remove(path)
+		self.queueManager.requeue_active()
+		self.resume_resolution()
 
 	def saveHistory(self):
-		finalList = {}
-		#Load history
-		queues = self.get_queue()
-		#Store
-		with open('history.yml', 'w') as f:
-			yaml.safe_dump(queues, f)
+		"""
+		Store a snapshot of the queues in the history file and drop the journal it includes
+		:return:
+		"""
+		self.metadataCache.save()
+		if self.queueBackend == self.BACKEND_SQLITE:
+			self.logging.info("History is stored in the database - Nothing to do")
+			return
+		with self.historyLock:
+			snapshot, rotated = self.queueManager.rotate_journal()
+			#Store atomically, one file for each line
+			fd, tempFile = tempfile.mkstemp(prefix=os.path.basename(self.history_file) + ".", suffix=".tmp",
+				dir=os.path.dirname(os.path.abspath(self.history_file)))
+			try:
+				with os.fdopen(fd, 'w', encoding='utf-8') as f:
+					for queue, files in snapshot.queues.items():
+						for file in files:
+							f.write(json.dumps(dict(file, queue=queue)) + "\n")
+					f.flush()
+					os.fsync(f.fileno())
+				os.replace(tempFile, self.history_file)
+			except BaseException:
+				if os.path.exists(tempFile):
+					os.remove(tempFile)
+				raise
+			if rotated:
+				os.remove(rotated)
+			# The legacy history is included in the new one
+			if os.path.isfile(self.legacy_history_file):
+				os.replace(self.legacy_history_file, self.legacy_history_file + ".migrated")
+			self.logging.info("History stored [version " + str(snapshot.version) + "]")
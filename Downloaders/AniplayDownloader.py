@@ -1,16 +1,21 @@
 import ast
+import copy
 import os
 import string
 import time
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterator
 from urllib.parse import unquote, urlparse
 from urllib.error import HTTPError
 import ffmpeg
 import requests
 from unidecode import unidecode
 
+from DownloadRecord import DownloadRecord
 from Downloaders.GenericDownloader import GenericDownloader
+from Downloaders.HlsDownload import HlsDownload, UnsupportedPlaylist
+from Downloaders.SegmentedDownload import SegmentedDownload
 
 
 class AniplayDownloader(GenericDownloader):
@@ -28,57 +33,89 @@ class AniplayDownloader(GenericDownloader):
 		"TE": "trailers"
 	}
 
+	directDownloadHeaders = {
+		"Referer": "https://aniplay.it/",
+		"User-Agent": headers["User-Agent"],
+		"Sec-Fetch-Site": "cross-site",
+		"Sec-Fetch-Mode": "navigate",
+		"Sec-Fetch-Dest": "document"
+	}
+
 	def __init__(self, configuration, logging, dm):
 		super().__init__(configuration, logging, dm)
 		self.logging.info("Aniplay Downloader - Created")
 		# The download status
 		self.percentage = 0
 
+	def process_download(self, file: DownloadRecord):
+		super().process_download(file)
+		# Drop the state of the previous download
+		self.percentage = 0
+		if hasattr(self, 'release'):
+			del self.release
+
 	def get_info(self, url: str) -> dict:
 		"""
 		Extract further information on this url
 		:param url: The url to analyze
-		:return: The object containing further information
+		:return: The object containing the episodes to download, produced while the seasons are retrieved
+		"""
+		return {'dir_value': self._expand_url(url)}
+
+	def _expand_url(self, url: str) -> Iterator[DownloadRecord]:
+		"""
+		Produce the episodes of a release or a single episode
+		:param url: The url to analyze
+		:return: The generator of the records
 		"""
-		res = {'dir_value': []}
 		if self.isARelease(url):
 			self.logging.info("Managing this release: [" + url + "]")
 			releaseLink = self.parseRelease(url)
-			self._retrieveReleaseInfo(releaseLink)
-			#Extract season episodes
-			if "seasons" in self.release and self.release["seasons"]:
-				for seasonInfo in self.release["seasons"]:
-					self.release["episodes"] += self._retrieveSeasonEpisodes(seasonInfo)
-			#Analyze all episodes
-			for episodeInfo in self.release["episodes"]:
-				name = self._createEpisodeName(episodeInfo)
-				episodeId = str(episodeInfo["id"])
-				epLink = "https://aniplay.it/api/download/episode/" + episodeId
-				domain = urlparse(epLink).netloc
-				res['dir_value'].append({'url': epLink, 'name': name, 'host': domain})
-				self.logging.info("Adding episode: " + name + " [" + epLink + "]")
+			if not self._retrieveReleaseInfo(releaseLink):
+				raise ImpossibleDownload("Cannot extract information on this release")
+			yield from self._createEpisodeRecords(self.release.get("episodes") or [])
+			#Extract season episodes, all the seasons are requested together
+			seasons = self.release.get("seasons") or []
+			if seasons:
+				executor = ThreadPoolExecutor(max_workers=min(len(seasons), self.settings.get('maxConcurrentRequests', 4)), thread_name_prefix="aniplay-season")
+				try:
+					futures = [executor.submit(self._retrieveSeasonEpisodes, seasonInfo) for seasonInfo in seasons]
+					# Keep the season order, each season is queued as soon as it and the previous ones are available
+					for future in futures:
+						yield from self._createEpisodeRecords(future.result())
+				finally:
+					executor.shutdown(wait=False, cancel_futures=True)
 		elif self.isAnEpisode(url):
 			epLink = self.parseEpisode(url)
 			episodeInfo = self._getDownloadEpisodeInfo(epLink)
 			if episodeInfo:
-				epName = self._createEpisodeName(episodeInfo)
-				domain = urlparse(epLink).netloc
-				res['dir_value'].append({'url': epLink, 'name': epName, 'host': domain})
-				self.logging.info("Adding episode: " + epName + " [" + epLink + "]")
+				yield from self._createEpisodeRecords([episodeInfo], epLink)
 			else:
 				self.logging.warning("Cannot extract info on this episode: [" + epLink + "]")
 		else:
 			self.logging.info("The passed url is not a supported Aniplay link: [" + url + "]")
 			print("Nothing to download")
-		return res
+
+	def _createEpisodeRecords(self, episodes: list, epLink: str = None) -> Iterator[DownloadRecord]:
+		"""
+		Create the records of some episodes
+		:param episodes: The information of the episodes
+		:param epLink: The link to use, if the episode was requested directly
+		:return: The generator of the records
+		"""
+		for episodeInfo in episodes:
+			name = self._createEpisodeName(episodeInfo)
+			link = epLink or "https://aniplay.it/api/download/episode/" + str(episodeInfo["id"])
+			self.logging.info("Adding episode: " + name + " [" + link + "]")
+			yield DownloadRecord(link, name, urlparse(link).netloc)
 
 	def _start_download(self) -> str:
 		self.logging.info("Starting download of this file: ", self.managing_file)
-		url = self.managing_file['url']
+		url = self.managing_file.url
 		start = time.time()
 		try:
 			downloadFileLocation = self._downloadFile(url)
-		except HTTPError:
+		except (HTTPError, requests.exceptions.HTTPError):
 			self.logging.warning("Direct download file not available [" + url + "] - Attempt download from streaming file")
 			downloadFileLocation = self._downloadStreamingFile(url)
 		downloadFileName = os.path.basename(downloadFileLocation)
@@ -100,12 +137,15 @@ class AniplayDownloader(GenericDownloader):
 		:param url: The url of a release
 		:return: True if it is possible to extract
 		"""
-		headers = self.headers
-		headers["Referer"] = url
-		response = requests.get(url, headers=headers)
+		cached = self._getCachedResponse(url)
+		if cached is not None:
+			self.release = cached
+			return True
+		response = self._api_get(url, url)
 		if response.status_code < 400:
 			try:
 				self.release = response.json()
+				self._cacheResponse(url, self.release)
 				return True
 			except requests.exceptions.JSONDecodeError as e:
 				print("WARNING - Cannot decode this release [" + str(e) + "]")
@@ -129,9 +169,8 @@ class AniplayDownloader(GenericDownloader):
 		:param episodeId: The episode id
 		:return: The direct link to the episode
 		"""
-		self.headers["Referer"] = "https://www.aniplay.it/download/" + episodeId
 		url = "https://aniplay.it/api/download/episode/" + episodeId + "/link"
-		response = requests.get(url, headers=self.headers)
+		response = self._api_get(url, "https://www.aniplay.it/download/" + episodeId)
 		return response.json()["downloadUrl"]
 
 	def _downloadFile(self, url: str) -> str:
@@ -153,17 +192,11 @@ class AniplayDownloader(GenericDownloader):
 		temp_location = os.path.join(self.getTempDir(), name)
 		self.logging.info("Starting direct download")
 		#Execute download
-		opener = urllib.request.build_opener()
-		opener.addheaders = [
-			('Referer', 'https://aniplay.it/'),
-			('User-Agent', self.headers['User-Agent']),
-			('Sec-Fetch-Site', 'cross-site'),
-			('Sec-Fetch-Mode', 'navigate'),
-			('Sec-Fetch-Dest', 'document')
-		]
-		urllib.request.install_opener(opener)
-		urllib.request.urlretrieve(directDownloadLink, temp_location, reporthook=self.download_hook)
-		return temp_location
+		download = SegmentedDownload(directDownloadLink, temp_location, self.directDownloadHeaders, self.logging,
+			connections=self._get_connections(), progress_hook=self.report_progress,
+			resume=self.managing_file.partial, state_hook=self.save_partial,
+			session=self.download_manager.httpPool.get_session(directDownloadLink), space_hook=self.reserve_space)
+		return download.run()
 
 	def _downloadStreamingFile(self, url: str) -> str:
 		"""
@@ -188,6 +221,15 @@ class AniplayDownloader(GenericDownloader):
 		# Execute download
 		self.logging.info("Starting streaming download")
 		print("Starting streaming download")
+		if urlparse(directDownloadLink).path.endswith(".m3u8"):
+			download = HlsDownload(directDownloadLink, temp_location, {"Referer": "https://aniplay.it/", "User-Agent": self.headers["User-Agent"]},
+				self.logging, connections=self._get_connections(), progress_hook=self.report_segment_progress,
+				resume=self.managing_file.partial, state_hook=self.save_partial,
+				session=self.download_manager.httpPool.get_session(directDownloadLink), ffmpeg_runner=self.run_ffmpeg)
+			try:
+				return download.run()
+			except UnsupportedPlaylist as e:
+				self.logging.warning("Cannot download the stream natively [" + str(e) + "] - Using ffmpeg")
 		self._downloadFileFromStreaming(directDownloadLink, temp_location, reporthook=self.download_hook)
 		return temp_location
 
@@ -204,14 +246,46 @@ class AniplayDownloader(GenericDownloader):
 		name = name + extension
 		return name
 
+	def _get_connections(self) -> int:
+		"""
+		The connections used by a single download, never more than the shared pool keeps for a host,
+		otherwise its segments would wait for each other
+		:return: The number of connections
+		"""
+		return min(self.settings.get('connectionsPerHost', 4), self.download_manager.httpPool.maxConnectionsPerHost)
+
 	def download_hook(self, blockTrasferred: int, blockSize: int, totalSize: int):
+		self.report_progress(blockTrasferred*blockSize, totalSize)
+
+	def report_progress(self, downloadSize: int, totalSize: int):
+		"""
+		Report the progress of the download, stopping it if requested
+		:param downloadSize: The downloaded bytes
+		:param totalSize: The size of the file, 0 if unknown
+		:return:
+		"""
 		self.check_download_to_stop()
-		downloadSize = blockTrasferred*blockSize
-		percentage = round(downloadSize * 100 / totalSize, 1)
+		if totalSize <= 0:
+			return
+		self._update_percentage(round(downloadSize * 100 / totalSize, 1), "Downloaded " + str("%.2f" % (downloadSize / 1024 / 1024)) + "MB of " + str("%.2f" % (totalSize / 1024 / 1024)) + "MB")
+
+	def report_segment_progress(self, writtenSegments: int, totalSegments: int):
+		"""
+		Report the progress of a stream downloaded by segments, whose size is unknown, stopping it if requested
+		:param writtenSegments: The segments written
+		:param totalSegments: The segments of the stream
+		:return:
+		"""
+		self.check_download_to_stop()
+		if totalSegments <= 0:
+			return
+		self._update_percentage(round(writtenSegments * 100 / totalSegments, 1), "Downloaded " + str(writtenSegments) + " segments of " + str(totalSegments))
+
+	def _update_percentage(self, percentage: float, message: str):
 		if percentage != self.percentage:
 			self.percentage = percentage
-			print(str("%.2f" % self.percentage) + "% - Downloaded " + str("%.2f" % (downloadSize / 1024 / 1024)) + "MB of " + str("%.2f" % (totalSize / 1024 / 1024)) + "MB")
-		self.download_manager.update_download_progress(self.managing_file['url'], self.percentage)
+			print(str("%.2f" % self.percentage) + "% - " + message)
+		self.download_manager.update_download_progress(self.downloadId, self.percentage)
 
 	def _createEpisodeName(self, episodeInfo) -> str:
 		"""
@@ -311,14 +385,16 @@ class AniplayDownloader(GenericDownloader):
 		:param apiUrl : The url to the specific episode
 		:return: The information related to the episode
 		"""
+		cached = self._getCachedResponse(apiUrl)
+		if cached is not None:
+			return cached
 		episodeId = self._extractEpisodeCode(apiUrl)
-		self.headers["Referer"] = "https://www.aniplay.it/download/" + episodeId
-		response = requests.get(apiUrl, headers=self.headers)
+		response = self._api_get(apiUrl, "https://www.aniplay.it/download/" + episodeId)
 		if response.status_code >= 400:
 			self.logging.warning("Episode download not available: [" + str(response.status_code) + "]")
-			self.logging.warning("URL: [" + apiUrl + "] - Headers: [" + str(self.headers) + "]")
+			self.logging.warning("URL: [" + apiUrl + "] - Headers: [" + str(response.request.headers) + "]")
 			return {}
-		return response.json()
+		return self._cacheResponse(apiUrl, response.json())
 
 	def _getStreamingEpisodeInfo(self, url: str) -> dict:
 		"""
@@ -328,13 +404,15 @@ class AniplayDownloader(GenericDownloader):
 		"""
 		episodeId = self._extractEpisodeCode(url)
 		apiUrl = "https://aniplay.it/api/episode/" + episodeId
-		self.headers["Referer"] = "https://www.aniplay.it/play/" + episodeId
-		response = requests.get(apiUrl, headers=self.headers)
+		cached = self._getCachedResponse(apiUrl)
+		if cached is not None:
+			return cached
+		response = self._api_get(apiUrl, "https://www.aniplay.it/play/" + episodeId)
 		if response.status_code >= 400:
 			self.logging.warning("Episode streaming not available: [" + str(response.status_code) + "]")
-			self.logging.warning("URL: [" + apiUrl + "] - Headers: [" + str(self.headers) + "]")
+			self.logging.warning("URL: [" + apiUrl + "] - Headers: [" + str(response.request.headers) + "]")
 			return {}
-		return response.json()
+		return self._cacheResponse(apiUrl, response.json())
 
 	@staticmethod
 	def isARelease(url: str) -> bool:
@@ -367,21 +445,6 @@ class AniplayDownloader(GenericDownloader):
 			print(parse)
 			return False
 
-	def moveToFinalLocation(self, temp_location: str, name: str):
-		"""
-		Moves the downloaded file to the final location
-		:param temp_location: The current file position
-		:param name: The name of the file to move
-		:return:
-		"""
-		finalDir = self.options['outtmpl']
-		if '%' in os.path.basename(finalDir):
-			#Ignoring the output format provided
-			finalDir = os.path.dirname(finalDir)
-		finalLocation = os.path.join(finalDir, name)
-		os.replace(temp_location, finalLocation)
-		self.logging.info("File [" + name + "] moved to dir [" + finalDir + "]")
-
 	@staticmethod
 	def makeSafeFilename(inputFilename):
 		unidecodedName = unidecode(inputFilename)
@@ -413,7 +476,7 @@ class AniplayDownloader(GenericDownloader):
 		output_ffmpeg = ffmpeg.output(stream, temp_location, vcodec='copy', acodec='copy')
 		output_ffmpeg = ffmpeg.overwrite_output(output_ffmpeg)
 		self.logging.info("Start downloading streaming file")
-		ffmpeg.run(output_ffmpeg, quiet=True)
+		self.run_ffmpeg(output_ffmpeg)
 
 	def _retrieveSeasonEpisodes(self, seasonInfo: dict) -> list:
 		"""
@@ -425,11 +488,39 @@ class AniplayDownloader(GenericDownloader):
 		seasonId = str(seasonInfo['id'])
 		self.logging.info("Extracting episodes from season: " + seasonInfo['name'] + " [" + seasonId + "]")
 		url = "https://aniplay.it/api/anime/" + animeId + "/season/" + seasonId
+		cached = self._getCachedResponse(url)
+		if cached is not None:
+			return cached
 		refererUrl = "https://aniplay.it/anime/" + animeId
-		headers = self.headers
-		headers["Referer"] = refererUrl
-		response = requests.get(url, headers=headers)
-		return response.json()
+		response = self._api_get(url, refererUrl)
+		return self._cacheResponse(url, response.json())
+
+	def _getCachedResponse(self, url: str):
+		"""
+		Retrieve an API response from the metadata cache shared by all the downloaders
+		:param url: The API url
+		:return: A copy of the response content. None if not cached
+		"""
+		return self.download_manager.metadataCache.get("aniplay:" + url)
+
+	def _cacheResponse(self, url: str, content):
+		"""
+		Store an API response in the metadata cache shared by all the downloaders
+		:param url: The API url
+		:param content: The decoded response content
+		:return: The content, the cache keeps its own copy
+		"""
+		self.download_manager.metadataCache.put("aniplay:" + url, copy.deepcopy(content))
+		return content
+
+	def _api_get(self, url: str, referer: str) -> requests.Response:
+		"""
+		Call the Aniplay API through the shared keep-alive sessions
+		:param url: The API url
+		:param referer: The page that would perform the call on the website
+		:return: The response
+		"""
+		return self.download_manager.httpPool.get(url, headers=dict(self.headers, Referer=referer))
 
 
 class ImpossibleDownload(Exception):
@@ -1,59 +1,132 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import yt_dlp
-import urllib.request
 
 from Downloaders.GenericDownloader import GenericDownloader
 
 
 class CrunchyrollDownloader(GenericDownloader):
+	"""
+	Downloads an episode with a single extraction, fetching the subtitle while the video downloads.
+	The selected formats are downloaded with YoutubeDL.dl, which skips YoutubeDL.process_info:
+	sleep_interval is still applied by the yt-dlp downloader, but the download archive and the yt-dlp postprocessors do not run.
+	Neither can be configured for this downloader, the merge is replaced by the mux with the subtitle
+	and a stream that may need a container fixup (HLS, DASH) is always remuxed.
+	"""
 
 	def __init__(self, settings, logging_handler, dm):
 		super().__init__(settings, logging_handler, dm)
 		print(settings)
 
-	def _start_download(self) -> None:
-		url = self.managing_file['url']
-		options = {
-			'writesubtitles': True,
-			'skip_download': True,
-		}
-		if 'outtmpl' in self.options:
-			options['outtmpl'] = self.options['outtmpl']
-		if 'subtitleslangs' in self.options:
-			options['subtitleslangs'] = self.options['subtitleslangs']
-		lang = options['subtitleslangs'][0]
-
-		with yt_dlp.YoutubeDL(options) as ydl:
-			#Preparing subtitle file
-			info_dict = ydl.extract_info(url, download=False)
-			videoName = ydl.prepare_filename(info_dict)
-			lang_parsed = lang[:2] + "-" + lang[2:]
-			sub_ext_info = info_dict.get('subtitles', {}).get(lang_parsed, [{}])[0]
-			sub_ext = sub_ext_info.get('ext', None)
-			directDownloadLink = sub_ext_info.get('url', None)
-			if sub_ext and directDownloadLink:
-				subtitleName = os.path.splitext(videoName)[0] + "." + lang + "." + sub_ext
-				self.logging.info("Downloading subtitle file: " + subtitleName)
-				urllib.request.urlretrieve(directDownloadLink, subtitleName)
-			else:
-				subtitleName = None
-				self.logging.warning("Cannot extract subtitle language - Skipping selection")
+	def _start_download(self) -> str:
+		url = self.managing_file.url
+		start = time.monotonic()
+		lang = self.options.get('subtitleslangs', [None])[0]
 
 		with yt_dlp.YoutubeDL(self.options) as ydl:
-			print("Downloading video file: " + videoName)
-			info_dict = ydl.extract_info(url, download=True)
-			videoName = ydl.prepare_filename(info_dict)
-			outputName = os.path.splitext(videoName)[0] + ".mkv"
-
-		if subtitleName:
-			#Impress subtitle only if found
-			self.joinVideo(videoName, subtitleName, lang, outputName)
-		self.logging.info("Downloaded file: " + outputName)
-		if os.path.isfile(outputName):
-			os.remove(subtitleName)
-			os.remove(videoName)
-			self.logging.info("Deleted temporary files")
-		else:
-			self.logging.warning("Cannot delete temporary files ["+subtitleName+"]["+videoName+"] - SKIP")
+			# A single extraction and format selection for both the subtitle and the video
+			info_dict = self.process_url(ydl, url, download=False)
+			selected = (info_dict.get('requested_downloads') or [info_dict])[0]
+			videoName = ydl.prepare_filename(selected)
+			baseName = os.path.splitext(videoName)[0]
+			outputName = baseName + ".mkv"
+			extracted = time.monotonic()
+
+			executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="subtitle")
+			try:
+				subtitle = executor.submit(self._downloadSubtitle, info_dict, lang, baseName) if lang else None
+				print("Downloading video file: " + videoName)
+				streams = self._downloadFormats(ydl, selected, baseName)
+				downloaded = time.monotonic()
+				subtitleName = self._waitSubtitle(subtitle)
+			finally:
+				executor.shutdown(wait=False)
+
+		self.logging.info("Episode fetched in " + str(round(time.monotonic() - start, 2)) + "s (extraction " + str(round(extracted - start, 2))
+			+ "s, video " + str(round(downloaded - extracted, 2)) + "s, subtitle wait " + str(round(time.monotonic() - downloaded, 2)) + "s) [" + url + "]")
+
+		if not subtitleName and len(streams) == 1 and selected.get('protocol') in ['http', 'https']:
+			# Nothing to mux, the downloaded file is the final one
+			os.replace(streams[0], videoName)
+			return os.path.basename(videoName)
+
+		def muxEpisode(stop_check: callable) -> str:
+			# The streams and the subtitle are written once, in the merge yt-dlp would have run
+			self.joinVideo(streams, subtitleName, lang, outputName, stop_check)
+			self.logging.info("Downloaded file: " + outputName)
+			if os.path.isfile(outputName):
+				for name in streams + ([subtitleName] if subtitleName else []):
+					os.remove(name)
+				self.logging.info("Deleted temporary files")
+			else:
+				self.logging.warning("Cannot delete temporary files " + str(streams) + "[" + str(subtitleName) + "] - SKIP")
+			return os.path.basename(outputName)
+
+		# The mux runs on the post processing workers, freeing the download slot
+		self.postProcessing = muxEpisode
 		return os.path.basename(outputName)
+
+	def _downloadFormats(self, ydl: yt_dlp.YoutubeDL, selected: dict, baseName: str) -> list:
+		"""
+		Download the selected formats without letting yt-dlp merge them, the merge is done together with the subtitle
+		:param ydl: The instance that selected the formats
+		:param selected: The information of the selected download
+		:param baseName: The path of the episode, without extension
+		:return: The downloaded files, in the order of the selected formats
+		"""
+		os.makedirs(os.path.dirname(baseName) or ".", exist_ok=True)
+		formats = selected.get('requested_formats') or [selected]
+		expectedSize = sum(fmt.get('filesize') or fmt.get('filesize_approx') or 0 for fmt in formats)
+		if expectedSize:
+			self.reserve_space(int(expectedSize))
+		streams = []
+		for fmt in formats:
+			formatInfo = dict(selected)
+			formatInfo.update(fmt)
+			formatInfo.pop('requested_formats', None)
+			# Same naming of the yt-dlp merge, so that its partial files are resumed
+			name = baseName + ".f" + str(fmt['format_id']) + "." + fmt['ext']
+			success, _ = ydl.dl(name, formatInfo)
+			if not success:
+				raise yt_dlp.utils.DownloadError("Cannot download format " + str(fmt['format_id']) + " [" + self.managing_file.url + "]")
+			streams.append(name)
+		return streams
+
+	def _downloadSubtitle(self, info_dict: dict, lang: str, baseName: str) -> str:
+		"""
+		Download the subtitle of the requested language, while the video is downloading
+		:param info_dict: The extracted information of the episode
+		:param lang: The requested language (e.g. itIT)
+		:param baseName: The path of the episode, without extension
+		:return: The location of the subtitle, None if not available
+		"""
+		lang_parsed = lang[:2] + "-" + lang[2:]
+		sub_ext_info = info_dict.get('subtitles', {}).get(lang_parsed, [{}])[0]
+		sub_ext = sub_ext_info.get('ext', None)
+		directDownloadLink = sub_ext_info.get('url', None)
+		if not sub_ext or not directDownloadLink:
+			self.logging.warning("Cannot extract subtitle language - Skipping selection")
+			return None
+		subtitleName = baseName + "." + lang + "." + sub_ext
+		self.logging.info("Downloading subtitle file: " + subtitleName)
+		response = self.download_manager.httpPool.get(directDownloadLink)
+		response.raise_for_status()
+		with open(subtitleName, 'wb') as f:
+			f.write(response.content)
+		return subtitleName
+
+	def _waitSubtitle(self, subtitle) -> str:
+		"""
+		Wait the subtitle download, a missing subtitle does not fail the episode
+		:param subtitle: The future of the subtitle download, None if no subtitle was requested
+		:return: The location of the subtitle, None if not available
+		"""
+		if subtitle is None:
+			return None
+		try:
+			return subtitle.result()
+		except Exception as e:
+			self.logging.warning("Cannot download subtitle [" + self.managing_file.url + "] - Skipping: " + str(e))
+			return None
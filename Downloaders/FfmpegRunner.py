@@ -0,0 +1,120 @@
+import logging
+import queue
+import subprocess
+import threading
+import time
+from collections import deque
+import ffmpeg
+import psutil
+
+
+class FfmpegRunner:
+	"""
+	Runs an ffmpeg command as a subprocess reading its -progress output, so that it can report the progress,
+	be stopped while running and be killed when it stalls
+	"""
+
+	# Seconds between two checks of the stop request
+	pollInterval = 0.5
+
+	def __init__(self, logging_handler: 'logging', stallTimeout: float = 60, progress_hook: callable = None, stop_check: callable = None):
+		"""
+		:param logging_handler: The logger
+		:param stallTimeout: The seconds without progress after which ffmpeg is killed
+		:param progress_hook: Called with the percentage (None if the duration is unknown) and the output bytes per second
+		:param stop_check: Called periodically, raises to stop ffmpeg
+		"""
+		self.logging = logging_handler
+		self.stallTimeout = stallTimeout
+		self.progress_hook = progress_hook
+		self.stop_check = stop_check
+
+	def run(self, stream_spec, duration: float = None) -> dict:
+		"""
+		Execute ffmpeg until completion
+		:param stream_spec: The ffmpeg-python output to run
+		:param duration: The seconds of media to process, used to compute the percentage
+		:return: The statistics of the job: wall and CPU seconds, output size and average throughput
+		"""
+		args = ffmpeg.compile(stream_spec)
+		args = args[:1] + ['-nostats', '-progress', 'pipe:1'] + args[1:]
+		start = time.monotonic()
+		process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		monitor = psutil.Process(process.pid)
+		progress = queue.Queue()
+		stderrTail = deque(maxlen=20)
+		threading.Thread(target=self._read_progress, args=(process.stdout, progress), daemon=True).start()
+		threading.Thread(target=lambda: stderrTail.extend(line.decode(errors='replace').rstrip() for line in process.stderr), daemon=True).start()
+		cpuTime = 0.0
+		size = 0
+		lastProgress = time.monotonic()
+		try:
+			while True:
+				try:
+					values = progress.get(timeout=self.pollInterval)
+				except queue.Empty:
+					values = {}
+				if values is None:
+					break
+				if values:
+					lastProgress = time.monotonic()
+					if values.get('total_size', "").isnumeric():
+						size = int(values['total_size'])
+					self._report(values, duration, size, lastProgress - start)
+				try:
+					cpuTimes = monitor.cpu_times()
+					cpuTime = cpuTimes.user + cpuTimes.system
+				except psutil.Error:
+					pass
+				if self.stop_check:
+					self.stop_check()
+				if time.monotonic() - lastProgress > self.stallTimeout:
+					raise FfmpegStalled("No progress from ffmpeg in " + str(self.stallTimeout) + "s")
+		except BaseException:
+			self.logging.warning("Killing ffmpeg [" + str(process.pid) + "]")
+			process.kill()
+			process.wait()
+			raise
+		returnCode = process.wait()
+		wall = time.monotonic() - start
+		if returnCode != 0:
+			raise FfmpegError("ffmpeg exited with code " + str(returnCode) + ": " + " | ".join(stderrTail))
+		stats = {'wall': round(wall, 2), 'cpu': round(cpuTime, 2), 'size': size, 'throughput': round(size / wall) if wall else 0}
+		self.logging.info("ffmpeg completed - Wall " + str(stats['wall']) + "s, CPU " + str(stats['cpu']) + "s, " + str(size) + " bytes")
+		return stats
+
+	@staticmethod
+	def _read_progress(stream, progress: queue.Queue):
+		"""
+		Parse the key=value blocks written by -progress, each one ends with the progress key
+		:param stream: The stdout of ffmpeg
+		:param progress: Receives a dictionary for each block and None at the end
+		:return:
+		"""
+		values = {}
+		for line in stream:
+			key, _, value = line.decode(errors='replace').strip().partition("=")
+			values[key] = value
+			if key == 'progress':
+				progress.put(values)
+				values = {}
+		progress.put(None)
+
+	def _report(self, values: dict, duration: float, size: int, elapsed: float):
+		if not self.progress_hook:
+			return
+		percentage = None
+		outTime = values.get('out_time_us', values.get('out_time_ms', ""))
+		if duration and outTime.isnumeric():
+			percentage = min(100.0, round(int(outTime) / 1000000 / duration * 100, 1))
+		if values.get('progress') == 'end':
+			percentage = 100.0
+		self.progress_hook(percentage, size / elapsed if elapsed > 0 else 0)
+
+
+class FfmpegError(Exception):
+	pass
+
+
+class FfmpegStalled(FfmpegError):
+	pass
@@ -1,10 +1,15 @@
+import hashlib
+import json
 import os
-import shutil
-import threading
-from urllib.parse import urlparse
+import time
+from typing import Iterator
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 import ffmpeg
 import yt_dlp
 from datetime import timedelta
+from DownloadRecord import DownloadRecord
+from Downloaders.FfmpegRunner import FfmpegRunner
+from QueueManager import QueueManager
 
 
 def sizeof_fmt(num, suffix='B'):
@@ -15,7 +20,33 @@ def sizeof_fmt(num, suffix='B'):
 	return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
-class GenericDownloader(threading.Thread):
+def canonical_url(url: str) -> str:
+	"""
+	Normalize an url, so that the different links to the same video share the same cache entry
+	:param url: The url to normalize
+	:return: The canonical url
+	"""
+	parse = urlparse(url.strip())
+	domain = parse.netloc.lower()
+	for prefix in ["www.", "m."]:
+		if domain.startswith(prefix):
+			domain = domain[len(prefix):]
+	path = parse.path
+	query = parse_qs(parse.query)
+	if domain == "youtu.be":
+		domain, query, path = "youtube.com", {'v': [path.strip("/")]}, "/watch"
+	elif domain == "youtube.com" and path.startswith("/shorts/"):
+		query, path = {'v': [path[len("/shorts/"):].strip("/")]}, "/watch"
+	if domain == "youtube.com" and path == "/watch":
+		# Drop the tracking and playback parameters
+		query = {key: query[key] for key in ['v', 'list'] if key in query}
+	return urlunparse(("https", domain, path, "", urlencode(query, doseq=True), ""))
+
+
+class GenericDownloader:
+	"""
+	Downloads the files assigned by process_download, one at a time. An instance is reused for many downloads
+	"""
 
 	lang = {
 		'itIT': 'Italian'
@@ -36,22 +67,47 @@ class GenericDownloader(threading.Thread):
 		'tempDir'
 	]
 
+	# Maximum number of url redirections followed while expanding an url
+	maxRedirections = 3
+
+	# Seconds between two saves of the state of a partial download
+	partialSaveInterval = 5
+
 	def __init__(self, settings, logging_handler, download_manager):
-		super().__init__()
 		self.download_manager = download_manager
 		self.logging = logging_handler
 		self.managing_file = None
+		self.downloadId = None
+		self.lastPartialSave = 0
+		# True once the disk space of the current download is reserved
+		self.spaceReserved = False
+		# The work left after the download, set by _start_download to run it on the post processing workers
+		self.postProcessing = None
 		self.tempDir = None
 		self.finalDir = None
 		sectionName = download_manager.extractSettingsAssociationFromDownloaderName(type(self).__name__)['settingsSectionName']
-		self.options = self.compose_option(settings.get_config(sectionName))
+		# The whole section, including the settings not passed to yt-dlp
+		self.settings = settings.get_config(sectionName)
+		self.options = self.compose_option(self.settings)
+		# The information depends on the options used to extract it (e.g. login or cookies), they are cached separately
+		self.cacheScope = sectionName + ":" + hashlib.sha1(json.dumps(self.settings, sort_keys=True, default=str).encode()).hexdigest()[:12]
 
 	def run(self) -> None:
-		url = self.managing_file['url']
-		self.download_manager.registerDownloader(url, self)
+		"""
+		Download the file set with process_download and report the outcome to the manager
+		:return:
+		"""
+		url = self.managing_file.url
+		self.downloadId = self.download_manager.registerDownloader(url, self)
 		try:
 			title = self._start_download()
-			self.completeDownload(title)
+			if self.postProcessing:
+				# The post processing must not use the state of this instance, it is reused for the next download
+				self.download_manager.post_process_this_download(self.managing_file, self.postProcessing, self.finalize)
+			else:
+				self.completeDownload(title)
+		except InsufficientDiskSpace:
+			self.download_manager.defer_this_download(self.managing_file)
 		except StopDownload:
 			print("Download paused [" + url + "]")
 			self.logging.info("Download paused [" + url + "]")
@@ -68,31 +124,145 @@ class GenericDownloader(threading.Thread):
 		"""
 		Extract further information on this url
 		:param url: The url to analyze
-		:return: The object containing further information
+		:return: The object containing the files to download, produced lazily while the playlists are listed
 		"""
-		with yt_dlp.YoutubeDL({}) as ydl:
-			info_dict = ydl.extract_info(url, download=False)
-			video_title = info_dict.get('title', None)
-			domain = urlparse(url).netloc
+		return {'dir_value': self._expand_url(url)}
+
+	def _expand_url(self, url: str) -> Iterator[DownloadRecord]:
+		"""
+		Produce the files to download from an url: a single video or every entry of a playlist or channel
+		:param url: The url to analyze
+		:return: The generator of the records, following the pages of the playlist
+		"""
+		# Same options of the download, so that the formats and the subtitles reserved to a logged user are listed
+		with yt_dlp.YoutubeDL(self.options) as ydl:
+			info_dict = ydl.extract_info(url, download=False, process=False)
+			# Follow the redirections to another url (e.g. a video inside a playlist)
+			for _ in range(self.maxRedirections):
+				if info_dict.get('_type') not in ['url', 'url_transparent'] or not info_dict.get('url') or info_dict['url'] == url:
+					break
+				info_dict = ydl.extract_info(info_dict['url'], download=False, process=False, ie_key=info_dict.get('ie_key'))
+			if info_dict.get('_type') in ['playlist', 'multi_video']:
+				self.logging.info("Expanding playlist: " + str(info_dict.get('title')) + " [" + url + "]")
+				yield from self._expand_playlist(info_dict)
+				return
+			self.download_manager.metadataCache.put(self._cache_key(url), ydl.sanitize_info(info_dict))
+			video_title = info_dict.get('title') or url
 			self.logging.info("Added url: " + video_title)
-			return {'url': url, 'name': video_title, 'host': domain}
+			yield DownloadRecord(url, video_title, urlparse(url).netloc, size=self._expected_size(info_dict))
+
+	def _expand_playlist(self, info_dict: dict) -> Iterator[DownloadRecord]:
+		"""
+		Produce a record for each entry of a playlist, without extracting the entries
+		:param info_dict: The unprocessed playlist information, whose entries may be a lazy generator
+		:return: The generator of the records
+		"""
+		for entry in info_dict.get('entries') or []:
+			if not entry:
+				continue
+			if entry.get('_type') == 'playlist':
+				yield from self._expand_playlist(entry)
+				continue
+			entryUrl = entry.get('url') or entry.get('webpage_url')
+			if not entryUrl:
+				self.logging.warning("Skipping playlist entry without url: " + str(entry.get('id')))
+				continue
+			yield DownloadRecord(entryUrl, entry.get('title') or entryUrl, urlparse(entryUrl).netloc, size=self._expected_size(entry))
 
-	def process_download(self, file: dict):
+	@staticmethod
+	def _expected_size(info_dict: dict) -> int:
+		"""
+		Find the size of a file from its unprocessed information, so that its disk space is checked before it is admitted
+		:param info_dict: The information of the file
+		:return: The size in bytes. None if the extractor does not report it
+		"""
+		size = info_dict.get('filesize') or info_dict.get('filesize_approx')
+		return int(size) if size else None
+
+	def retrieve_info(self, ydl: yt_dlp.YoutubeDL, url: str, use_cache: bool = True) -> dict:
+		"""
+		Retrieve the unprocessed information of an url, extracting them only if they are not in the metadata cache
+		:param ydl: The instance used to extract the information
+		:param url: The url to analyze
+		:param use_cache: False to force a new extraction
+		:return: The information, ready to be passed to process_ie_result
+		"""
+		key = self._cache_key(url)
+		cache = self.download_manager.metadataCache
+		info_dict = cache.get(key) if use_cache else None
+		if info_dict is None:
+			info_dict = ydl.sanitize_info(ydl.extract_info(url, download=False, process=False))
+			cache.put(key, info_dict)
+			self.logging.info("Extracted information of: " + url)
+		return info_dict
+
+	def process_url(self, ydl: yt_dlp.YoutubeDL, url: str, download: bool) -> dict:
+		"""
+		Process the information of an url, reusing the cached information when available
+		:param ydl: The instance used to process the information
+		:param url: The url to process
+		:param download: True to download the selected formats
+		:return: The processed information
+		"""
+		info_dict = self.download_manager.metadataCache.get(self._cache_key(url))
+		if info_dict is not None:
+			try:
+				return ydl.process_ie_result(info_dict, download=download)
+			except yt_dlp.utils.DownloadError as e:
+				# The cached links may have expired, retry with fresh information
+				self.logging.warning("Cannot process cached information of " + url + " - Extracting again: " + str(e))
+		return ydl.process_ie_result(self.retrieve_info(ydl, url, use_cache=False), download=download)
+
+	def _cache_key(self, url: str) -> str:
+		"""
+		Compute the metadata cache key of an url, extracted with the options of this downloader
+		:param url: The url
+		:return: The key
+		"""
+		return self.cacheScope + ":" + canonical_url(url)
+
+	def process_download(self, file: DownloadRecord):
 		"""
 		Set the file to download
 		:param file: The file containing all the information to manage
 		:return:
 		"""
 		self.managing_file = file
+		self.managing_file.stop = False
+		self.lastPartialSave = 0
+		self.spaceReserved = False
+		self.postProcessing = None
 		self.logging.info("Start managing this file: [" + str(file) + "]")
 
+	def reserve_space(self, size: int):
+		"""
+		Reserve the disk space still needed by the current download, deferring it if the space is not available
+		:param size: The bytes that will be written. 0 once they are allocated on disk
+		:return:
+		"""
+		self.spaceReserved = True
+		if not self.download_manager.reserve_disk_space(self.managing_file, size):
+			raise InsufficientDiskSpace("Not enough disk space for " + sizeof_fmt(size) + " [" + self.managing_file.url + "]")
+
+	def save_partial(self, partial: dict, force: bool = False):
+		"""
+		Store the state of the partial download in the queue record, at most once every partialSaveInterval seconds
+		:param partial: The state needed to resume the download
+		:param force: True to store it immediately
+		:return:
+		"""
+		now = time.monotonic()
+		if force or now - self.lastPartialSave >= self.partialSaveInterval:
+			self.lastPartialSave = now
+			self.download_manager.save_download_state(self.managing_file, partial)
+
 	def stop_download(self):
 		"""
 		Set the parameter to stop the download
 		:return:
 		"""
-		self.logging.info("Pausing download of: " + self.managing_file['url'])
-		self.managing_file['stop'] = True
+		self.logging.info("Pausing download of: " + self.managing_file.url)
+		self.managing_file.stop = True
 
 	def _start_download(self) -> str:
 		"""
@@ -100,27 +270,32 @@ class GenericDownloader(threading.Thread):
 		:return: The filename of the downloaded files
 		"""
 		with yt_dlp.YoutubeDL(self.options) as ydl:
-			url = self.managing_file['url']
+			url = self.managing_file.url
 			print("Downloading: " + url)
-			result = ydl.extract_info("{}".format(url), download=False)
+			result = self.process_url(ydl, url, download=True)
 			title = ydl.prepare_filename(result)
-			self.logging.info("Preparing download of: " + str(title))
-			print("Preparing download of: " + str(title))
-			ydl.download([url])
+			self.logging.info("Downloaded: " + str(title))
 			return title
 
 	def completeDownload(self, title):
-		if self.tempDir:
-			try:
-				shutil.move(os.path.join(self.tempDir, title), os.path.join(self.finalDir, title))
-				self.logging.debug("Moved " + title + " from [" + self.finalDir + "] to [" + self.tempDir + "]")
-				print("Moved " + title + " from [" + self.tempDir + "] to [" + self.finalDir + "]")
-			except FileNotFoundError:
-				self.logging.warning('Cannot find downloaded file: ' + os.path.join(self.tempDir, title))
-				print('Cannot find file: ' + os.path.join(self.tempDir, title))
+		self.finalize(self.managing_file, title)
+
+	def finalize(self, file: DownloadRecord, title: str):
+		"""
+		Move the downloaded file to its final directory and complete the download
+		:param file: The downloaded file
+		:param title: The name of the downloaded file
+		:return:
+		"""
+		source_queue = self.download_manager.locate_download(file)
 		self.logging.info("Successfully downloaded: " + str(title))
 		print("Successfully downloaded: " + str(title))
-		self.download_manager.complete_this_download(self.managing_file)
+		if self.tempDir:
+			# Renamed when possible, otherwise copied in background freeing the download slot
+			self.download_manager.finalize_this_download(file, os.path.join(self.tempDir, title), os.path.join(self.finalDir, title),
+				source_queue or QueueManager.DOWNLOAD_ACTIVE)
+		else:
+			self.download_manager.complete_this_download(file, source_queue or QueueManager.DOWNLOAD_ACTIVE)
 
 	def compose_option(self, settings: dict) -> dict:
 		"""
@@ -130,7 +305,10 @@ class GenericDownloader(threading.Thread):
 		"""
 		output_settings = {
 			'progress_hooks': [self.my_hook],
-			'logger': self.logging.getLogger()
+			'logger': self.logging.getLogger(),
+			# Keep the .part files and continue them after a pause or a restart
+			'continuedl': True,
+			'nopart': False
 		}
 		# Fill required parameters
 		for key in self.requiredParameters:
@@ -173,10 +351,10 @@ class GenericDownloader(threading.Thread):
 		return output_settings
 
 	def check_download_to_stop(self):
-		if 'stop' in self.managing_file and self.managing_file['stop']:
-			self.logging.info("Stopping download [" + self.managing_file['url'] + "]")
-			print("Stopping download  [" + self.managing_file['url'] + "]")
-			raise StopDownload("Stopping download  [" + self.managing_file['url'] + "]")
+		if self.managing_file.stop:
+			self.logging.info("Stopping download [" + self.managing_file.url + "]")
+			print("Stopping download  [" + self.managing_file.url + "]")
+			raise StopDownload("Stopping download  [" + self.managing_file.url + "]")
 
 	def my_hook(self, d: dict):
 		time = str("{:0>8}".format(str(timedelta(seconds=d['elapsed'])))) if 'elapsed' in d else ""
@@ -184,6 +362,12 @@ class GenericDownloader(threading.Thread):
 		size = sizeof_fmt(size_in_bytes)
 		complete_filename = d['filename']
 		filename = os.path.basename(complete_filename)
+		if d['status'] == 'downloading' and d.get('tmpfilename'):
+			# yt-dlp resumes the .part file by itself, the record keeps track of it
+			self.save_partial({'location': d['tmpfilename'], 'size': d.get('downloaded_bytes')}, force=self.managing_file.stop)
+		if d['status'] == 'downloading' and not self.spaceReserved and not self.managing_file.size and (d.get('total_bytes') or d.get('total_bytes_estimate')):
+			# The size was unknown when the file was admitted, the first report carries it before most of the file is downloaded
+			self.reserve_space(int((d.get('total_bytes') or d.get('total_bytes_estimate')) - (d.get('downloaded_bytes') or 0)))
 		self.check_download_to_stop()
 		if d['status'] == 'finished':
 			print(
@@ -197,34 +381,70 @@ class GenericDownloader(threading.Thread):
 			# print(
 			# 	"Downloading " + str(percentage) + "% (" + str(downloaded_bytes) + "/" + str(size_in_bytes) + " bytes) [" + filename +
 			# 	"] - Elapsed: " + time + "s - ETA: " + str(d['eta']) + "s")
-			self.download_manager.update_download_progress(self.managing_file['url'], percentage)
+			self.download_manager.update_download_progress(self.downloadId, percentage)
 		else:
 			print("Unexpected error during download: " + str(d))
 
 	# self.logging("Unexpected error during download: " + str(d))
 
-	def joinVideo(self, video, subtitle, subtitleLang, output_file):
-		subtitleLang = subtitleLang[:2]
-		input_ffmpeg = ffmpeg.input(video)
-		input_ffmpeg_sub = ffmpeg.input(subtitle)
-
-		input_video = input_ffmpeg['v']
-		input_audio = input_ffmpeg['a']
-		input_subtitles = input_ffmpeg_sub['s']
+	def joinVideo(self, video, subtitle, subtitleLang, output_file, stop_check: callable = None):
+		"""
+		Mux the downloaded streams and the subtitle in a single pass, without transcoding
+		:param video: The downloaded file or the list of files of the selected formats (e.g. video and audio)
+		:param subtitle: The subtitle file, None to only merge the formats
+		:param subtitleLang: The language of the subtitle
+		:param output_file: The muxed file
+		:param stop_check: Raises to stop ffmpeg
+		:return:
+		"""
+		videos = [video] if isinstance(video, str) else video
+		if len(videos) == 1:
+			input_ffmpeg = ffmpeg.input(videos[0])
+			streams = [input_ffmpeg['v'], input_ffmpeg['a']]
+		else:
+			# Every stream of each format, as the merge of yt-dlp
+			streams = [ffmpeg.input(name) for name in videos]
+		options = {}
+		if subtitle:
+			streams.append(ffmpeg.input(subtitle)['s'])
+			options = {
+				'metadata:s:s:0': "language=" + subtitleLang[:2],
+				'disposition:s:0': "forced"
+			}
 
 		output_ffmpeg = ffmpeg.output(
-			input_video, input_audio, input_subtitles, output_file,
+			*streams, output_file,
 			vcodec='copy', acodec='copy',
-			**{
-				'metadata:s:s:0': "language=" + subtitleLang,
-				'disposition:s:0': "forced"
-			}
+			**options
 		)
 		# If the destination file already exists, overwrite it.
 		output_ffmpeg = ffmpeg.overwrite_output(output_ffmpeg)
 		self.logging.info("Start processing file")
+		try:
+			duration = float(ffmpeg.probe(videos[0])['format']['duration'])
+		except (ffmpeg.Error, KeyError, ValueError):
+			duration = None
 		# Do it! transcode!
-		ffmpeg.run(output_ffmpeg)
+		self.run_ffmpeg(output_ffmpeg, duration, stop_check)
+
+	def run_ffmpeg(self, stream_spec, duration: float = None, stop_check: callable = None) -> dict:
+		"""
+		Run ffmpeg reporting its progress, stopping it if a pause is requested and killing it if it stalls
+		:param stream_spec: The ffmpeg-python output to run
+		:param duration: The seconds of media to process, used to compute the percentage
+		:param stop_check: Raises to stop ffmpeg. If missing, the pause of the current download is checked and its progress reported
+		:return: The statistics of the job
+		"""
+		runner = FfmpegRunner(self.logging, self.download_manager.get_optional_config('GlobalSettings', 'ffmpegStallTimeout', 60),
+			progress_hook=None if stop_check else self._ffmpeg_progress, stop_check=stop_check or self.check_download_to_stop)
+		stats = runner.run(stream_spec, duration)
+		print("ffmpeg job completed in " + str(stats['wall']) + "s (CPU " + str(stats['cpu']) + "s) - " + sizeof_fmt(stats['size']))
+		return stats
+
+	def _ffmpeg_progress(self, percentage: float, throughput: float):
+		if percentage is not None:
+			self.download_manager.update_download_progress(self.downloadId, percentage)
+		self.logging.debug("ffmpeg progress: " + str(percentage) + "% at " + sizeof_fmt(throughput) + "/s")
 
 
 class MissingRequiredParameter(Exception):
@@ -233,3 +453,7 @@ class MissingRequiredParameter(Exception):
 
 class StopDownload(Exception):
 	pass
+
+
+class InsufficientDiskSpace(Exception):
+	pass
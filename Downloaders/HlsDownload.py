@@ -0,0 +1,188 @@
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+import ffmpeg
+import requests
+
+
+class HlsDownload:
+	"""
+	Downloads an HLS stream (m3u8): the segments are fetched concurrently within a bounded window,
+	appended in order to a single transport stream and remuxed once at the end.
+	Only clear streams are supported, the encrypted ones raise UnsupportedPlaylist.
+	"""
+
+	attributePattern = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+	def __init__(self, url: str, location: str, headers: dict, logging_handler: 'logging', connections: int = 4,
+				 progress_hook: callable = None, retries: int = 3, timeout: float = 30,
+				 resume: dict = None, state_hook: callable = None, session: requests.Session = None, ffmpeg_runner: callable = None):
+		"""
+		:param url: The url of the playlist
+		:param location: Where the remuxed file will be written
+		:param headers: The headers sent with every request
+		:param logging_handler: The logger
+		:param connections: The number of segments downloaded simultaneously
+		:param progress_hook: Called with the segments written and the total segments, may raise to stop the download
+		:param retries: The attempts for each segment after a failure
+		:param timeout: The seconds waited for the server
+		:param resume: The state of a previous attempt, as returned by get_state
+		:param state_hook: Called with the current state and True when it must be stored immediately (download interrupted)
+		:param session: A shared session to use. If missing a session is created for this download
+		:param ffmpeg_runner: Runs the remux command. If missing ffmpeg is run directly
+		"""
+		self.url = url
+		self.location = location
+		self.streamLocation = location + ".ts"
+		self.headers = headers
+		self.logging = logging_handler
+		self.connections = max(1, connections)
+		# Segments downloaded in advance, waiting to be written
+		self.window = 2 * self.connections
+		self.progress_hook = progress_hook
+		self.retries = retries
+		self.timeout = timeout
+		self.resume = resume
+		self.state_hook = state_hook
+		self.ownSession = session is None
+		self.session = session or requests.Session()
+		self.ffmpeg_runner = ffmpeg_runner or (lambda stream_spec: ffmpeg.run(stream_spec, quiet=True))
+		self.segments = []
+		self.written = 0
+		self.offset = 0
+
+	def run(self) -> str:
+		"""
+		Download the stream
+		:return: The location of the remuxed file
+		"""
+		try:
+			self.segments = self._load_playlist(self.url)
+			self._download_segments()
+			self._remux()
+			return self.location
+		except BaseException:
+			if self.segments and self.state_hook:
+				self.state_hook(self.get_state(), True)
+			raise
+		finally:
+			if self.ownSession:
+				self.session.close()
+
+	def get_state(self) -> dict:
+		"""
+		Describe the progress of the download, so that it can be resumed
+		:return: The location of the stream, the segments written and their size
+		"""
+		return {'location': self.streamLocation, 'hlsSegments': len(self.segments), 'hlsWritten': self.written, 'offset': self.offset}
+
+	def _get_text(self, url: str) -> str:
+		response = self.session.get(url, headers=self.headers, timeout=self.timeout)
+		response.raise_for_status()
+		return response.text
+
+	def _load_playlist(self, url: str) -> list:
+		"""
+		Retrieve the segments of the stream, choosing the best variant of a master playlist
+		:param url: The url of the playlist
+		:return: The urls of the segments, in order
+		"""
+		lines = [line.strip() for line in self._get_text(url).splitlines() if line.strip()]
+		if not lines or lines[0] != "#EXTM3U":
+			raise UnsupportedPlaylist("Not an HLS playlist [" + url + "]")
+		variants = []
+		segments = []
+		for idx, line in enumerate(lines):
+			if line.startswith("#EXT-X-STREAM-INF:") and idx + 1 < len(lines):
+				attributes = self._parse_attributes(line)
+				variants.append((int(attributes.get('BANDWIDTH', 0) or 0), urljoin(url, lines[idx + 1])))
+			elif line.startswith("#EXT-X-KEY:") and self._parse_attributes(line).get('METHOD', "NONE") != "NONE":
+				raise UnsupportedPlaylist("Encrypted stream [" + url + "]")
+			elif line.startswith("#EXT-X-BYTERANGE"):
+				raise UnsupportedPlaylist("Byte range segments [" + url + "]")
+			elif line.startswith("#EXT-X-MAP:"):
+				segments.append(urljoin(url, self._parse_attributes(line)['URI']))
+			elif not line.startswith("#"):
+				segments.append(urljoin(url, line))
+		if variants:
+			bandwidth, variantUrl = max(variants)
+			self.logging.info("Selected stream variant of " + str(bandwidth) + " bps [" + variantUrl + "]")
+			return self._load_playlist(variantUrl)
+		if not segments:
+			raise UnsupportedPlaylist("Empty playlist [" + url + "]")
+		return segments
+
+	def _parse_attributes(self, line: str) -> dict:
+		return {key: value.strip('"') for key, value in self.attributePattern.findall(line.split(":", 1)[1])}
+
+	def _download_segments(self):
+		"""
+		Fetch the segments concurrently and append them in order to the stream file
+		:return:
+		"""
+		start = 0
+		mode = 'wb'
+		if self.resume and self.resume.get('location') == self.streamLocation and self.resume.get('hlsSegments') == len(self.segments) \
+				and os.path.isfile(self.streamLocation) and os.path.getsize(self.streamLocation) >= self.resume.get('offset', 0):
+			start = self.resume['hlsWritten']
+			self.offset = self.resume['offset']
+			mode = 'r+b'
+			self.logging.info("Resuming stream [" + self.url + "] from segment " + str(start) + " of " + str(len(self.segments)))
+		self.written = start
+		self.logging.info("Downloading " + str(len(self.segments) - start) + " segments [" + self.url + "]")
+		executor = ThreadPoolExecutor(max_workers=self.connections, thread_name_prefix="hls")
+		try:
+			with open(self.streamLocation, mode) as f:
+				# Drop what was written after the last stored state
+				f.truncate(self.offset)
+				f.seek(self.offset)
+				pending = {}
+				for idx in range(start, len(self.segments)):
+					for ahead in range(idx, min(idx + self.window, len(self.segments))):
+						if ahead not in pending:
+							pending[ahead] = executor.submit(self._fetch_segment, self.segments[ahead])
+					f.write(pending.pop(idx).result())
+					f.flush()
+					self.written = idx + 1
+					self.offset = f.tell()
+					# The hook may stop the download, between two segments
+					if self.progress_hook:
+						self.progress_hook(self.written, len(self.segments))
+					if self.state_hook:
+						self.state_hook(self.get_state(), False)
+		finally:
+			executor.shutdown(wait=False, cancel_futures=True)
+
+	def _fetch_segment(self, url: str) -> bytes:
+		"""
+		Download a segment, retrying it on failure
+		:param url: The segment url
+		:return: The segment content
+		"""
+		attempt = 0
+		while True:
+			try:
+				response = self.session.get(url, headers=self.headers, timeout=self.timeout)
+				response.raise_for_status()
+				return response.content
+			except requests.exceptions.RequestException as e:
+				attempt += 1
+				if attempt > self.retries:
+					raise
+				self.logging.warning("Retrying segment [" + url + "] - " + str(e))
+
+	def _remux(self):
+		"""
+		Copy the transport stream in the final container, without transcoding
+		:return:
+		"""
+		self.logging.info("Remuxing stream into [" + self.location + "]")
+		output_ffmpeg = ffmpeg.output(ffmpeg.input(self.streamLocation), self.location, c='copy')
+		self.ffmpeg_runner(ffmpeg.overwrite_output(output_ffmpeg))
+		os.remove(self.streamLocation)
+
+
+class UnsupportedPlaylist(Exception):
+	pass
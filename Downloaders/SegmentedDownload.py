@@ -0,0 +1,250 @@
+import errno
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SegmentedDownload:
+	"""
+	Downloads a file over several connections, each one fetching a byte range into a preallocated file.
+	When the size is known the whole file is allocated before downloading, so a full disk is detected immediately.
+	Falls back to a single stream, that cannot be resumed, if the server does not support ranges.
+	An interrupted download can be resumed from its state, if the remote file did not change.
+	"""
+
+	chunkSize = 1024 * 1024
+
+	def __init__(self, url: str, location: str, headers: dict, logging_handler: 'logging', connections: int = 4,
+				 progress_hook: callable = None, retries: int = 3, minSegmentSize: int = 4 * 1024 * 1024, timeout: float = 30,
+				 resume: dict = None, state_hook: callable = None, session: requests.Session = None, space_hook: callable = None):
+		"""
+		:param url: The url of the file
+		:param location: Where the file will be written
+		:param headers: The headers sent with every request
+		:param logging_handler: The logger
+		:param connections: The maximum number of simultaneous connections
+		:param progress_hook: Called with the downloaded bytes and the total size, may raise to stop the download
+		:param retries: The attempts for each segment after a failure
+		:param minSegmentSize: Files are not split in segments smaller than this size
+		:param timeout: The seconds waited for the server
+		:param resume: The state of a previous attempt, as returned by get_state
+		:param state_hook: Called with the current state and True when it must be stored immediately (download interrupted)
+		:param session: A shared session to use. If missing a session is created for this download
+		:param space_hook: Called with the bytes to write before writing them and with 0 once they are allocated, may raise to refuse the download
+		"""
+		self.url = url
+		self.location = location
+		self.headers = headers
+		self.logging = logging_handler
+		self.connections = max(1, connections)
+		self.progress_hook = progress_hook
+		self.retries = retries
+		self.minSegmentSize = minSegmentSize
+		self.timeout = timeout
+		self.resume = resume
+		self.state_hook = state_hook
+		self.space_hook = space_hook
+		self.downloaded = 0
+		self.totalSize = 0
+		self.validators = {}
+		# Each segment as [first byte, last byte, next byte to download]
+		self.segments = []
+		self.lock = threading.Lock()
+		# Set when a segment fails definitely, the other segments stop
+		self.aborted = threading.Event()
+		self.ownSession = session is None
+		if self.ownSession:
+			session = requests.Session()
+			session.mount("https://", HTTPAdapter(pool_maxsize=self.connections))
+			session.mount("http://", HTTPAdapter(pool_maxsize=self.connections))
+		self.session = session
+
+	def run(self) -> str:
+		"""
+		Download the file
+		:return: The location of the downloaded file
+		"""
+		try:
+			totalSize, rangeSupported = self._probe()
+			if self._can_resume(totalSize, rangeSupported):
+				# The partial file already holds its space
+				self._reserve(0)
+				self._download_segments(totalSize, self.resume['segments'])
+			elif not rangeSupported or not totalSize:
+				self.logging.info("Ranges not supported, downloading in a single connection [" + self.url + "]")
+				self._download_single()
+			else:
+				# A small file or a single connection is still a segment, its state allows to resume it
+				self._download_segments(totalSize)
+			return self.location
+		except BaseException:
+			if self.segments and self.state_hook:
+				self.state_hook(self.get_state(), True)
+			raise
+		finally:
+			if self.ownSession:
+				self.session.close()
+
+	def get_state(self) -> dict:
+		"""
+		Describe the progress of a segmented download, so that it can be resumed
+		:return: The location, the validators of the remote file and the segments
+		"""
+		with self.lock:
+			return dict(self.validators, location=self.location, size=self.totalSize, segments=[list(segment) for segment in self.segments])
+
+	def _can_resume(self, totalSize: int, rangeSupported: bool) -> bool:
+		"""
+		Check if the previous attempt can be continued: same remote file and partial file still available
+		:param totalSize: The size of the remote file
+		:param rangeSupported: True if the server supports ranges
+		:return: True if the download can be resumed
+		"""
+		if not self.resume or not rangeSupported or not self.resume.get('segments'):
+			return False
+		if self.resume.get('location') != self.location or self.resume.get('size') != totalSize:
+			self.logging.info("Remote file changed or different location - Restarting download [" + self.url + "]")
+			return False
+		for key, value in self.validators.items():
+			if self.resume.get(key) and self.resume[key] != value:
+				self.logging.info("Remote file changed [" + key + "] - Restarting download [" + self.url + "]")
+				return False
+		if not os.path.isfile(self.location) or os.path.getsize(self.location) != totalSize:
+			self.logging.info("Partial file not available - Restarting download [" + self.url + "]")
+			return False
+		return True
+
+	def _probe(self) -> tuple:
+		"""
+		Request the first byte to check the support of ranges and the file size
+		:return: The size of the file (0 if unknown) and True if ranges are supported
+		"""
+		with self.session.get(self.url, headers=dict(self.headers, Range="bytes=0-0"), stream=True, timeout=self.timeout) as response:
+			response.raise_for_status()
+			contentRange = response.headers.get('Content-Range', "")
+			self.validators = {key: response.headers[header] for key, header in [('etag', 'ETag'), ('lastModified', 'Last-Modified')] if header in response.headers}
+			if response.status_code == 206 and "/" in contentRange and contentRange.rsplit("/", 1)[1].isnumeric():
+				return int(contentRange.rsplit("/", 1)[1]), response.headers.get('Content-Encoding') in [None, 'identity']
+			return int(response.headers.get('Content-Length', 0)), False
+
+	def _download_single(self):
+		with self.session.get(self.url, headers=self.headers, stream=True, timeout=self.timeout) as response:
+			response.raise_for_status()
+			self.totalSize = int(response.headers.get('Content-Length', 0))
+			with open(self.location, 'wb') as f:
+				if self.totalSize and response.headers.get('Content-Encoding') in [None, 'identity']:
+					self._reserve(self.totalSize)
+					self._preallocate(f.fileno(), self.totalSize)
+				for chunk in response.iter_content(self.chunkSize):
+					f.write(chunk)
+					self._report(len(chunk))
+				# Drop the preallocated space not written
+				f.truncate(f.tell())
+
+	def _download_segments(self, totalSize: int, segments: list = None):
+		"""
+		Split the file in ranges and download them concurrently
+		:param totalSize: The size of the file
+		:param segments: The segments of a previous attempt to resume. None to start from the beginning
+		:return:
+		"""
+		self.totalSize = totalSize
+		if segments:
+			self.segments = [list(segment) for segment in segments]
+			self.downloaded = sum(position - start for start, end, position in self.segments)
+			self.logging.info("Resuming [" + self.url + "] from " + str(self.downloaded) + " of " + str(totalSize) + " bytes")
+		else:
+			count = max(1, min(self.connections, totalSize // self.minSegmentSize))
+			segmentSize = totalSize // count
+			self.segments = [[idx * segmentSize, totalSize - 1 if idx == count - 1 else (idx + 1) * segmentSize - 1, idx * segmentSize] for idx in range(count)]
+			self._reserve(totalSize)
+			with open(self.location, 'wb') as f:
+				self._preallocate(f.fileno(), totalSize)
+			self.logging.info("Downloading [" + self.url + "] in " + str(count) + " segments of " + str(segmentSize) + " bytes")
+		pending = [segment for segment in self.segments if segment[2] <= segment[1]]
+		if not pending:
+			return
+		with ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix="segment") as executor:
+			futures = [executor.submit(self._download_segment, segment) for segment in pending]
+			errors = []
+			for future in futures:
+				try:
+					future.result()
+				except BaseException as e:
+					errors.append(e)
+		if errors:
+			raise errors[0]
+
+	def _reserve(self, size: int):
+		if self.space_hook:
+			self.space_hook(size)
+
+	def _preallocate(self, fd: int, size: int):
+		"""
+		Allocate the whole file on disk, avoiding its fragmentation and a late failure for a full disk
+		:param fd: The descriptor of the file
+		:param size: The size of the file
+		:return:
+		"""
+		try:
+			os.posix_fallocate(fd, 0, size)
+		except (AttributeError, OSError) as e:
+			if isinstance(e, OSError) and e.errno not in [errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS]:
+				raise
+			# Not supported by the filesystem, the file is only extended
+			os.ftruncate(fd, size)
+		self._reserve(0)
+
+	def _download_segment(self, segment: list):
+		"""
+		Download a byte range, resuming from the last written byte after a failure
+		:param segment: The first and last byte of the range and the next byte to download
+		:return:
+		"""
+		start, end, position = segment
+		attempt = 0
+		try:
+			# Unbuffered: the stored state never counts bytes that are not written yet
+			with open(self.location, 'r+b', buffering=0) as f:
+				while position <= end:
+					try:
+						headers = dict(self.headers, Range="bytes=" + str(position) + "-" + str(end))
+						with self.session.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+							if response.status_code != 206:
+								raise IncompleteSegment("Range not honoured [" + str(response.status_code) + "]")
+							f.seek(position)
+							for chunk in response.iter_content(self.chunkSize):
+								if self.aborted.is_set():
+									return
+								chunk = chunk[:end - position + 1]
+								f.write(chunk)
+								position += len(chunk)
+								self._report(len(chunk), segment, position)
+						if position <= end:
+							raise IncompleteSegment("Connection closed at byte " + str(position))
+					except (requests.exceptions.RequestException, IncompleteSegment) as e:
+						attempt += 1
+						if attempt > self.retries or self.aborted.is_set():
+							raise
+						self.logging.warning("Retrying segment " + str(start) + "-" + str(end) + " from byte " + str(position) + " [" + str(e) + "]")
+		except BaseException:
+			# Stop the other segments immediately, not when this failure is collected
+			self.aborted.set()
+			raise
+
+	def _report(self, size: int, segment: list = None, position: int = None):
+		with self.lock:
+			self.downloaded += size
+			if segment is not None:
+				segment[2] = position
+			if self.progress_hook:
+				self.progress_hook(self.downloaded, self.totalSize)
+		if segment is not None and self.state_hook:
+			self.state_hook(self.get_state(), False)
+
+
+class IncompleteSegment(Exception):
+	pass
@@ -0,0 +1,52 @@
+from __future__ import annotations
+import json
+from collections import deque
+from itertools import islice
+from threading import Condition
+from typing import Union
+
+
+class EventStream:
+	"""
+	A bounded log of the changes applied to the queues.
+	Every event is serialized once, when published, and shared by all the clients reading the stream.
+	"""
+
+	def __init__(self, size: int = 10000):
+		self.events = deque(maxlen=size)
+		self.sequence = 0
+		self.condition = Condition()
+
+	def publish(self, eventType: str, data: dict) -> int:
+		"""
+		Append a new event to the stream and wake up the waiting clients
+		:param eventType: The type of event (add, move, delete, progress)
+		:param data: The content of the event
+		:return: The sequence number of the event
+		"""
+		with self.condition:
+			self.sequence += 1
+			self.events.append((self.sequence, eventType, json.dumps(data)))
+			self.condition.notify_all()
+			return self.sequence
+
+	def read(self, since: int, timeout: float = None) -> Union[list, None]:
+		"""
+		Retrieve the events following a certain sequence number, waiting for new events if there are none
+		:param since: The sequence number of the last event received by the client
+		:param timeout: The maximum time to wait for new events
+		:return: The list of (sequence, type, data) events. None if the requested events are no longer available
+		"""
+		with self.condition:
+			# A sequence unknown by this stream must not wait, the client resynchronizes immediately
+			self.condition.wait_for(lambda: self.sequence != since, timeout)
+			if since > self.sequence:
+				# The client refers to a sequence unknown by this stream (e.g. before a restart)
+				return None
+			if since == self.sequence:
+				return []
+			if not self.events or self.events[0][0] > since + 1:
+				return None
+			# Events are consecutive, so the position of the first missing event is known
+			start = since + 1 - self.events[0][0]
+			return list(islice(self.events, start, None))
@@ -0,0 +1,221 @@
+from __future__ import annotations
+import errno
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from DownloadRecord import DownloadRecord
+from QueueManager import QueueManager
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# ioctl cloning the extents of a file (reflink), supported by btrfs and XFS
+FICLONE = 0x40049409
+
+# The errors of a kernel copy that is not available for this pair of files
+UNSUPPORTED_COPY = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+
+class FileMover:
+	"""
+	Moves the downloaded files to their final directory.
+	A file on the same device is renamed, otherwise it is copied by the kernel (reflink, copy_file_range or sendfile)
+	on the mover workers, so that a copy of a large file does not hold a download slot.
+	"""
+
+	# Bytes copied between two checks of the stop request
+	chunkSize = 64 * 1024 * 1024
+
+	def __init__(self, dm: 'DownloaderManager', logging_handler: 'logging', size: int):
+		self.dm = dm
+		self.logging = logging_handler
+		self.size = max(1, size)
+		self.executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="mover")
+		self.lock = threading.Lock()
+		self.waiting = 0
+		self.active = {}
+		self.renamed = 0
+		self.copied = {}
+		self.failed = 0
+		self.bytesCopied = 0
+		self.copyTime = 0.0
+
+	def rename(self, source: str, destination: str) -> bool:
+		"""
+		Move a file with a rename, when the source and the destination are on the same device
+		:param source: The file to move
+		:param destination: The final location of the file
+		:return: False if the file is on another device and must be copied
+		"""
+		try:
+			os.replace(source, destination)
+		except OSError as e:
+			if e.errno != errno.EXDEV:
+				raise
+			return False
+		with self.lock:
+			self.renamed += 1
+		self.logging.info("Renamed [" + source + "] to [" + destination + "]")
+		return True
+
+	def submit(self, file: DownloadRecord, source: str, destination: str, done: callable, failed: callable):
+		"""
+		Schedule the copy of a file to another device
+		:param file: The downloaded file, already in the post processing queue
+		:param source: The file to move
+		:param destination: The final location of the file
+		:param done: Called when the file is in its final location
+		:param failed: Called when the file cannot be moved
+		:return:
+		"""
+		with self.lock:
+			self.waiting += 1
+		self.executor.submit(self._run, file, source, destination, done, failed)
+
+	def _run(self, file: DownloadRecord, source: str, destination: str, done: callable, failed: callable):
+		with self.lock:
+			self.waiting -= 1
+			self.active[file.url] = {'file': os.path.basename(destination), 'size': 0, 'copied': 0}
+		start = time.monotonic()
+		try:
+			size = os.path.getsize(source)
+			with self.lock:
+				self.active[file.url]['size'] = size
+
+			def progress(copied: int):
+				with self.lock:
+					self.active[file.url]['copied'] = copied
+
+			method = self.move(source, destination, progress, lambda: self._check_removed(file))
+			elapsed = time.monotonic() - start
+			size = os.path.getsize(destination)
+			with self.lock:
+				self.copied[method] = self.copied.get(method, 0) + 1
+				self.bytesCopied += size
+				self.copyTime += elapsed
+			self.logging.info("Moved [" + source + "] to [" + destination + "] with " + method + " in " + str(round(elapsed, 2)) + "s")
+			print("Moved " + os.path.basename(destination) + " to [" + os.path.dirname(destination) + "] in " + str(round(elapsed, 2)) + "s")
+			done()
+		except StopMove:
+			self.logging.info("Move stopped, the file was removed [" + file.url + "]")
+		except BaseException as e:
+			self.logging.error("Cannot move [" + source + "] to [" + destination + "]: " + str(e))
+			print("Cannot move [" + source + "] to [" + destination + "]: " + str(e))
+			with self.lock:
+				self.failed += 1
+			failed()
+		finally:
+			with self.lock:
+				del self.active[file.url]
+
+	def move(self, source: str, destination: str, progress: callable = None, stop_check: callable = None) -> str:
+		"""
+		Move a file, copying it when it cannot be renamed.
+		The copy is written next to the destination and renamed once complete, the source is removed at the end.
+		:param source: The file to move
+		:param destination: The final location of the file
+		:param progress: Called with the bytes copied
+		:param stop_check: Called between two chunks, raises to stop the copy
+		:return: The method used: rename, reflink, copy_file_range, sendfile or read
+		"""
+		try:
+			os.replace(source, destination)
+			return "rename"
+		except OSError as e:
+			if e.errno != errno.EXDEV:
+				raise
+		tempDestination = destination + ".moving"
+		try:
+			with open(source, 'rb') as src, open(tempDestination, 'wb') as dst:
+				method = self._copy(src.fileno(), dst.fileno(), os.fstat(src.fileno()).st_size, progress, stop_check)
+			shutil.copystat(source, tempDestination)
+			os.replace(tempDestination, destination)
+		except BaseException:
+			if os.path.exists(tempDestination):
+				os.remove(tempDestination)
+			raise
+		os.remove(source)
+		return method
+
+	def _copy(self, src: int, dst: int, size: int, progress: callable, stop_check: callable) -> str:
+		"""
+		Copy the content of a file, inside the kernel with the first method supported by the two filesystems
+		:param src: The descriptor of the source
+		:param dst: The descriptor of the destination, empty
+		:param size: The bytes to copy
+		:return: The method used
+		"""
+		if fcntl and size:
+			try:
+				fcntl.ioctl(dst, FICLONE, src)
+				if progress:
+					progress(size)
+				return "reflink"
+			except OSError as e:
+				if e.errno not in UNSUPPORTED_COPY + (errno.ENOTTY,):
+					raise
+		methods = [method for method in ["copy_file_range", "sendfile"] if hasattr(os, method)] + ["read"]
+		offset = 0
+		while offset < size:
+			if stop_check:
+				stop_check()
+			count = min(self.chunkSize, size - offset)
+			try:
+				copied = self._copy_chunk(methods[0], src, dst, offset, count)
+			except OSError as e:
+				if e.errno not in UNSUPPORTED_COPY or len(methods) == 1:
+					raise
+				self.logging.debug(methods[0] + " not supported [" + str(e) + "] - Falling back to " + methods[1])
+				methods.pop(0)
+				continue
+			if copied == 0:
+				raise IOError("Source file truncated during the copy at " + str(offset) + " of " + str(size) + " bytes")
+			offset += copied
+			if progress:
+				progress(offset)
+		return methods[0]
+
+	@staticmethod
+	def _copy_chunk(method: str, src: int, dst: int, offset: int, count: int) -> int:
+		if method == "copy_file_range":
+			return os.copy_file_range(src, dst, count, offset, offset)
+		if method == "sendfile":
+			os.lseek(dst, offset, os.SEEK_SET)
+			return os.sendfile(dst, src, offset, count)
+		data = os.pread(src, min(count, 1024 * 1024), offset)
+		return os.pwrite(dst, data, offset)
+
+	def _check_removed(self, file: DownloadRecord):
+		"""
+		Stop the copy of a file deleted from the queue
+		:param file: The moved file
+		:return:
+		"""
+		if self.dm.queueManager.retrieveFileFromUrl(file.url, [QueueManager.DOWNLOAD_POSTPROCESSING])[0] is None:
+			raise StopMove("File removed from the post processing queue")
+
+	def get_metrics(self) -> dict:
+		with self.lock:
+			return {
+				'workers': self.size,
+				'waiting': self.waiting,
+				'active': [
+					dict(job, percentage=round(job['copied'] / job['size'] * 100, 1) if job['size'] else 100.0)
+					for job in self.active.values()
+				],
+				'renamed': self.renamed,
+				'copied': dict(self.copied),
+				'failed': self.failed,
+				'bytesCopied': self.bytesCopied,
+				'copySeconds': round(self.copyTime, 2),
+				'throughput': round(self.bytesCopied / self.copyTime) if self.copyTime else 0
+			}
+
+
+class StopMove(Exception):
+	pass
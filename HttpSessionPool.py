@@ -0,0 +1,136 @@
+from __future__ import annotations
+import logging
+import threading
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HttpSessionPool:
+	"""
+	Keep-alive HTTP sessions shared by all the downloaders, one for each host, with a bounded number of connections.
+	The headers are passed with each request, the sessions are never modified after their creation.
+	"""
+
+	def __init__(self, logging_handler: 'logging', maxConnectionsPerHost: int = 8, timeout: float = 30, poolTimeout: float = 120):
+		"""
+		:param logging_handler: The logger
+		:param maxConnectionsPerHost: The connections kept open to the same host
+		:param timeout: The seconds waited for the server
+		:param poolTimeout: The seconds waited for a free connection when all the connections to the host are in use
+		"""
+		self.logging = logging_handler
+		self.maxConnectionsPerHost = max(1, maxConnectionsPerHost)
+		self.timeout = timeout
+		self.poolTimeout = poolTimeout
+		# Host -> session
+		self.sessions = {}
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get_session(self, url: str) -> requests.Session:
+		"""
+		Retrieve the session of the host of an url, creating it on first use
+		:param url: The requested url
+		:return: The shared session
+		"""
+		host = urlparse(url).netloc
+		with self.lock:
+			session = self.sessions.get(host)
+			if session is not None:
+				self.hits += 1
+				return session
+			self.misses += 1
+			session = requests.Session()
+			# Wait for a free connection instead of opening more than the limit
+			adapter = BoundedAdapter(self.maxConnectionsPerHost, self.poolTimeout)
+			session.mount("https://", adapter)
+			session.mount("http://", adapter)
+			self.sessions[host] = session
+		self.logging.info("Created HTTP session for host [" + host + "]")
+		return session
+
+	def get(self, url: str, headers: dict = None, **kwargs) -> requests.Response:
+		"""
+		Execute a GET request on the session of its host
+		:param url: The requested url
+		:param headers: The headers of this request only
+		:param kwargs: Further parameters of requests
+		:return: The response
+		"""
+		kwargs.setdefault('timeout', self.timeout)
+		return self.get_session(url).get(url, headers=headers, **kwargs)
+
+	def after_fork(self):
+		"""
+		Drop the sessions inherited from the parent process, their connections cannot be shared
+		:return:
+		"""
+		self.sessions = {}
+		self.lock = threading.Lock()
+
+	def get_stats(self) -> dict:
+		"""
+		Retrieve the usage of the sessions and of their connections
+		:return: The session hits and misses and, for each host, the requests sent and the connections opened
+		"""
+		with self.lock:
+			sessions = dict(self.sessions)
+			stats = {'hits': self.hits, 'misses': self.misses, 'hosts': {}}
+		for host, session in sessions.items():
+			requestCount = 0
+			connectionCount = 0
+			adapter = session.get_adapter("https://")
+			for key in list(adapter.poolmanager.pools.keys()):
+				pool = adapter.poolmanager.pools.get(key)
+				if pool is not None:
+					requestCount += pool.num_requests
+					connectionCount += pool.num_connections
+			stats['hosts'][host] = {'requests': requestCount, 'connections': connectionCount, 'reused': max(0, requestCount - connectionCount)}
+		return stats
+
+
+class BoundedAdapter(HTTPAdapter):
+	"""
+	An adapter that waits a bounded time for a free connection to its host.
+	requests never passes a pool timeout to urllib3, whose blocking pool would wait forever for a connection held by a stalled download:
+	a semaphore counts the responses holding a connection and is released with the connection.
+	"""
+
+	def __init__(self, maxConnections: int, poolTimeout: float, **kwargs):
+		"""
+		:param maxConnections: The connections kept open to the host
+		:param poolTimeout: The seconds waited for a free connection
+		:param kwargs: Further parameters of HTTPAdapter
+		"""
+		self.poolTimeout = poolTimeout
+		self.slots = threading.BoundedSemaphore(maxConnections)
+		super().__init__(pool_connections=1, pool_maxsize=maxConnections, pool_block=True, **kwargs)
+
+	def send(self, request, *args, **kwargs):
+		if not self.slots.acquire(timeout=self.poolTimeout):
+			raise PoolTimeout("No free connection to [" + urlparse(request.url).netloc + "] after " + str(self.poolTimeout) + " seconds", request=request)
+		try:
+			response = super().send(request, *args, **kwargs)
+		except BaseException:
+			self.slots.release()
+			raise
+		releaseConnection = response.raw.release_conn
+		# The connection is released when the body is consumed and again when the response is closed
+		released = threading.Lock()
+
+		def release_conn():
+			releaseConnection()
+			if released.acquire(blocking=False):
+				self.slots.release()
+
+		response.raw.release_conn = release_conn
+		return response
+
+
+class PoolTimeout(requests.exceptions.ConnectionError):
+	"""
+	No connection to the host was freed in time. A RequestException, retried like the other connection errors
+	"""
+	pass
@@ -0,0 +1,119 @@
+from __future__ import annotations
+import copy
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any
+
+
+class MetadataCache:
+	"""
+	Size-bounded LRU cache with expiration, shared by all the downloaders and optionally stored on disk.
+	The values must be JSON serializable to be stored.
+	"""
+
+	def __init__(self, logging_handler: 'logging', maxSize: int = 200, ttl: float = 3600, path: str = None):
+		self.logging = logging_handler
+		self.maxSize = maxSize
+		self.ttl = ttl
+		self.path = path
+		# Key -> (expiration time, value), the least recently used first
+		self.entries = OrderedDict()
+		self.lock = Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key: str) -> Any:
+		"""
+		Retrieve a value from the cache
+		:param key: The key of the value
+		:return: A copy of the value. None if missing or expired
+		"""
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None or entry[0] < time.time():
+				if entry is not None:
+					del self.entries[key]
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			value = entry[1]
+		# Callers are free to modify the returned value
+		return copy.deepcopy(value)
+
+	def put(self, key: str, value: Any, ttl: float = None):
+		"""
+		Store a value in the cache, evicting the least recently used values if the cache is full
+		:param key: The key of the value
+		:param value: The value to store
+		:param ttl: The seconds before the value expires. The default of the cache if not specified
+		:return:
+		"""
+		with self.lock:
+			self.entries[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxSize:
+				self.entries.popitem(last=False)
+
+	def invalidate(self, key: str):
+		"""
+		Remove a value from the cache
+		:param key: The key of the value
+		:return:
+		"""
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def copy(self) -> MetadataCache:
+		"""
+		Create an independent cache with the same values, not stored on disk
+		:return: The new cache
+		"""
+		cache = MetadataCache(self.logging, self.maxSize, self.ttl)
+		with self.lock:
+			cache.entries = OrderedDict(self.entries)
+		return cache
+
+	def get_stats(self) -> dict:
+		with self.lock:
+			return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+	def load(self):
+		"""
+		Load the values stored on disk that are not expired yet
+		:return:
+		"""
+		if not self.path or not os.path.isfile(self.path):
+			return
+		try:
+			with open(self.path, 'r', encoding='utf-8') as f:
+				stored = json.load(f)
+		except ValueError as e:
+			self.logging.warning("Cannot load metadata cache [" + self.path + "]: " + str(e))
+			return
+		now = time.time()
+		with self.lock:
+			for key, expiration, value in stored:
+				if expiration > now:
+					self.entries[key] = (expiration, value)
+			while len(self.entries) > self.maxSize:
+				self.entries.popitem(last=False)
+		self.logging.info("Loaded " + str(len(self.entries)) + " metadata cache entries")
+
+	def save(self):
+		"""
+		Store the values on disk, if a path is configured
+		:return:
+		"""
+		if not self.path:
+			return
+		with self.lock:
+			stored = [[key, expiration, value] for key, (expiration, value) in self.entries.items()]
+		tempFile = self.path + ".tmp"
+		with open(tempFile, 'w', encoding='utf-8') as f:
+			json.dump(stored, f)
+		os.replace(tempFile, self.path)
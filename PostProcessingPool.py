@@ -0,0 +1,88 @@
+from __future__ import annotations
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from DownloadRecord import DownloadRecord
+from QueueManager import QueueManager
+
+
+class PostProcessingPool:
+	"""
+	Runs the CPU and disk bound work left after a download (remux, subtitle embedding) on its own workers,
+	so that the download slot is freed as soon as the network transfer ends.
+	While waiting or running, the file is kept in the post processing queue.
+	"""
+
+	def __init__(self, dm: 'DownloaderManager', logging_handler: 'logging', size: int):
+		self.dm = dm
+		self.logging = logging_handler
+		self.size = max(1, size)
+		self.executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="postprocessing")
+		self.lock = threading.Lock()
+		self.waiting = 0
+		self.running = 0
+		self.completed = 0
+		self.failed = 0
+		self.totalTime = 0.0
+
+	def submit(self, file: DownloadRecord, job: callable, finalize: callable):
+		"""
+		Schedule the post processing of a downloaded file
+		:param file: The downloaded file, already in the post processing queue
+		:param job: Called with a function that raises StopPostProcessing if the file was removed, returns the final file name
+		:param finalize: Called with the file and the final file name to complete the download
+		:return:
+		"""
+		with self.lock:
+			self.waiting += 1
+		self.executor.submit(self._run, file, job, finalize)
+
+	def _run(self, file: DownloadRecord, job: callable, finalize: callable):
+		with self.lock:
+			self.waiting -= 1
+			self.running += 1
+		start = time.monotonic()
+		url = file.url
+		try:
+			self.logging.info("Post processing [" + url + "]")
+			title = job(lambda: self._check_removed(file))
+			finalize(file, title)
+			with self.lock:
+				self.completed += 1
+		except StopPostProcessing:
+			self.logging.info("Post processing stopped, the file was removed [" + url + "]")
+		except BaseException as e:
+			self.logging.error("Cannot post process " + url + " [" + str(e) + "]")
+			print("Cannot post process " + url + " [" + str(e) + "]")
+			with self.lock:
+				self.failed += 1
+			self.dm.fail_this_download(file, QueueManager.DOWNLOAD_POSTPROCESSING)
+		finally:
+			with self.lock:
+				self.running -= 1
+				self.totalTime += time.monotonic() - start
+
+	def _check_removed(self, file: DownloadRecord):
+		"""
+		Stop the post processing of a file deleted from the queue
+		:param file: The processed file
+		:return:
+		"""
+		if self.dm.queueManager.retrieveFileFromUrl(file.url, [QueueManager.DOWNLOAD_POSTPROCESSING])[0] is None:
+			raise StopPostProcessing("File removed from the post processing queue")
+
+	def get_metrics(self) -> dict:
+		with self.lock:
+			return {
+				'workers': self.size,
+				'waiting': self.waiting,
+				'running': self.running,
+				'completed': self.completed,
+				'failed': self.failed,
+				'totalSeconds': round(self.totalTime, 2)
+			}
+
+
+class StopPostProcessing(Exception):
+	pass
@@ -0,0 +1,75 @@
+from __future__ import annotations
+from array import array
+from collections import deque
+from threading import Lock
+
+NO_PROGRESS = -1.0
+
+
+class ProgressTable:
+	"""
+	Array-backed table containing the progress of the active downloads, one slot for each download.
+	The downloaders write their slot without any lock, the readers collect the changes at their own pace.
+	"""
+
+	def __init__(self, size: int):
+		self.values = array('d', [NO_PROGRESS] * size)
+		self.published = array('d', [NO_PROGRESS] * size)
+		self.urls = [None] * size
+		self.freeSlots = deque(range(size))
+		# Protects only the slot allocation, never taken by the writers
+		self.lock = Lock()
+
+	def register(self, url: str) -> int:
+		"""
+		Reserve a slot for a new download
+		:param url: The url of the download
+		:return: The download id, that is the slot to use to report the progress
+		"""
+		with self.lock:
+			if not self.freeSlots:
+				# More downloads than expected, double the table
+				size = len(self.urls)
+				self.values.extend([NO_PROGRESS] * size)
+				self.published.extend([NO_PROGRESS] * size)
+				self.urls.extend([None] * size)
+				self.freeSlots.extend(range(size, 2 * size))
+			slot = self.freeSlots.popleft()
+			self.values[slot] = NO_PROGRESS
+			self.published[slot] = NO_PROGRESS
+			self.urls[slot] = url
+			return slot
+
+	def release(self, slot: int):
+		"""
+		Free the slot of a download that is no longer active
+		:param slot: The download id
+		:return:
+		"""
+		with self.lock:
+			if self.urls[slot] is not None:
+				self.urls[slot] = None
+				self.freeSlots.append(slot)
+
+	def update(self, slot: int, percentage: float):
+		"""
+		Store the current progress of a download - Lock free
+		:param slot: The download id
+		:param percentage: The current download percentage
+		:return:
+		"""
+		self.values[slot] = percentage
+
+	def collect(self) -> dict:
+		"""
+		Retrieve the progress changed since the last collection
+		:return: A dictionary associating the url to the new percentage
+		"""
+		changes = {}
+		with self.lock:
+			for slot, url in enumerate(self.urls):
+				if url is not None and self.values[slot] != self.published[slot]:
+					value = self.values[slot]
+					self.published[slot] = value
+					changes[url] = value
+		return changes
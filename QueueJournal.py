@@ -0,0 +1,152 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import shutil
+import time
+
+
+class QueueJournal:
+	"""
+	Append-only journal of the changes applied to the queues.
+	The history file is the snapshot, the journal contains the changes applied after the snapshot was written.
+	"""
+
+	FSYNC_ALWAYS = "always"
+	FSYNC_INTERVAL = "interval"
+	FSYNC_NEVER = "never"
+
+	def __init__(self, path: str, logging_handler: 'logging', fsyncPolicy: str = FSYNC_INTERVAL, fsyncInterval: float = 1, compactEvery: int = 10000):
+		self.path = path
+		self.rotatedPath = path + ".1"
+		self.logging = logging_handler
+		if fsyncPolicy not in [self.FSYNC_ALWAYS, self.FSYNC_INTERVAL, self.FSYNC_NEVER]:
+			self.logging.warning("Invalid journal fsync policy [" + str(fsyncPolicy) + "] - Using " + self.FSYNC_INTERVAL)
+			fsyncPolicy = self.FSYNC_INTERVAL
+		self.fsyncPolicy = fsyncPolicy
+		self.fsyncInterval = fsyncInterval
+		self.compactEvery = compactEvery
+		self.entries = 0
+		self.lastSync = time.monotonic()
+		self.stream = None
+
+	def open(self):
+		"""
+		Open the journal to append new operations
+		:return:
+		"""
+		self.stream = open(self.path, 'a', encoding='utf-8')
+
+	def append(self, operation: dict):
+		"""
+		Write an operation at the end of the journal
+		:param operation: The operation to store
+		:return:
+		"""
+		self.stream.write(json.dumps(operation) + "\n")
+		self.stream.flush()
+		self.entries += 1
+		if self.fsyncPolicy == self.FSYNC_ALWAYS:
+			os.fsync(self.stream.fileno())
+		elif self.fsyncPolicy == self.FSYNC_INTERVAL and time.monotonic() - self.lastSync >= self.fsyncInterval:
+			os.fsync(self.stream.fileno())
+			self.lastSync = time.monotonic()
+
+	def needs_compaction(self) -> bool:
+		"""
+		Check if the journal is long enough to be compacted into a new snapshot
+		:return: True if a compaction should start
+		"""
+		return self.entries >= self.compactEvery
+
+	def rotate(self) -> str:
+		"""
+		Close the current journal and start a new one. The rotated journal must be kept until the new snapshot is stored.
+		The saves are serialized, so a rotated journal found here was left by a failed save: the current journal is appended to it
+		:return: The path of the rotated journal
+		"""
+		self.stream.close()
+		if os.path.exists(self.rotatedPath):
+			self.logging.warning("Merging the journal left by a failed compaction")
+			with open(self.path, 'rb') as source, open(self.rotatedPath, 'ab') as destination:
+				shutil.copyfileobj(source, destination)
+				destination.flush()
+				os.fsync(destination.fileno())
+			# A crash before the truncation leaves the operations in both journals, replaying them twice has no effect
+			self.stream = open(self.path, 'w', encoding='utf-8')
+		else:
+			os.replace(self.path, self.rotatedPath)
+			self.stream = open(self.path, 'a', encoding='utf-8')
+		self.entries = 0
+		return self.rotatedPath
+
+	def close(self):
+		"""
+		Sync and close the journal
+		:return:
+		"""
+		if self.stream and not self.stream.closed:
+			self.stream.flush()
+			os.fsync(self.stream.fileno())
+			self.stream.close()
+
+	@staticmethod
+	def replay(queues: dict, paths: list, logging_handler: 'logging') -> dict:
+		"""
+		Apply the journals to the queues loaded from the snapshot. Replaying an operation twice has no effect
+		:param queues: The queues loaded from the snapshot, each one is a list of files as dictionaries
+		:param paths: The journals to replay, oldest first
+		:param logging_handler: The logger
+		:return: The queues after the replay
+		"""
+		# Rebuild the url index
+		state = {queue: {} for queue in queues}
+		index = {}
+		for queue, files in queues.items():
+			for file in files or []:
+				if file['url'] not in index:
+					state[queue][file['url']] = file
+					index[file['url']] = queue
+		count = 0
+		for path in paths:
+			if not os.path.isfile(path):
+				continue
+			with open(path, 'r', encoding='utf-8') as stream:
+				for line in stream:
+					try:
+						operation = json.loads(line)
+					except ValueError:
+						# Partially written line from a crash, it is the last one
+						logging_handler.warning("Skipping corrupted journal line in [" + path + "]")
+						continue
+					url = operation['url']
+					if operation['op'] == 'add':
+						if url not in index:
+							state.setdefault(operation['queue'], {})[url] = operation['file']
+							index[url] = operation['queue']
+					elif operation['op'] == 'move':
+						if url in index:
+							file = state[index[url]].pop(url)
+							state.setdefault(operation['queue'], {})[url] = file
+							index[url] = operation['queue']
+					elif operation['op'] == 'delete':
+						if url in index:
+							del state[index.pop(url)][url]
+					elif operation['op'] == 'progress':
+						if url in index:
+							state[index[url]][url]['status'] = operation['status']
+					elif operation['op'] == 'partial':
+						if url in index:
+							if operation['partial'] is None:
+								state[index[url]][url].pop('partial', None)
+							else:
+								state[index[url]][url]['partial'] = operation['partial']
+					elif operation['op'] == 'size':
+						if url in index:
+							if operation['size'] is None:
+								state[index[url]][url].pop('size', None)
+							else:
+								state[index[url]][url]['size'] = operation['size']
+					count += 1
+		logging_handler.info("Replayed " + str(count) + " journal operations")
+		return {queue: list(files.values()) for queue, files in state.items()}
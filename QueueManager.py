@@ -1,42 +1,129 @@
 from __future__ import annotations
+import json
 import logging
+import uuid
+from collections import deque
+from itertools import count
+import threading
 from threading import Condition
-import copy
 from typing import Union
+from DownloadRecord import DownloadRecord
+from EventStream import EventStream
+from QueueStore import MemoryQueueStore
 
 
 class NoElementAvailable(Exception):
 	pass
 
 
+class QueueSnapshot:
+	"""
+	An immutable view of the queues at a certain version, shared by all the readers.
+	The files contained in the snapshot must never be modified.
+	The queues read a page at a time (the history of a database store) are not included, only their size is.
+	"""
+
+	def __init__(self, instanceId: str, version: int, sequence: int, queues: dict, counts: dict = None, names: list = None):
+		self.instanceId = instanceId
+		self.version = version
+		self.etag = instanceId + "-" + str(version)
+		# The last event of the stream already included in this snapshot
+		self.sequence = sequence
+		self.lastEventId = instanceId + "-" + str(sequence)
+		self.queues = queues
+		# The number of files of each queue not included in the snapshot
+		self.counts = counts if counts is not None else {}
+		# Every queue, in order
+		self.names = names if names is not None else list(queues)
+		self._json = None
+
+	def to_json(self) -> str:
+		"""
+		Serialize the snapshot, the result is computed only once
+		:return: The JSON representation of the queues
+		"""
+		if self._json is None:
+			self._json = json.dumps(self.queues)
+		return self._json
+
+
 class QueueManager:
 
+	DOWNLOAD_RESOLVING = "resolving"
 	DOWNLOAD_QUEUE = "downloadQueue"
 	DOWNLOAD_FAILED = "downloadFailed"
 	DOWNLOAD_ACTIVE = "inProgress"
+	DOWNLOAD_POSTPROCESSING = "postProcessing"
 	DOWNLOAD_PAUSED = "paused"
 	DOWNLOAD_COMPLETED = "downloadCompleted"
-	ALL_QUEUES = [DOWNLOAD_QUEUE, DOWNLOAD_FAILED, DOWNLOAD_ACTIVE, DOWNLOAD_PAUSED, DOWNLOAD_COMPLETED]
+	ALL_QUEUES = [DOWNLOAD_RESOLVING, DOWNLOAD_QUEUE, DOWNLOAD_FAILED, DOWNLOAD_ACTIVE, DOWNLOAD_POSTPROCESSING, DOWNLOAD_PAUSED, DOWNLOAD_COMPLETED]
 
-	def __init__(self, settings: 'IUBConfiguration', logging_handler: 'logging', dm: 'DownloaderManager'):
+	# The queues kept in memory also when using a persistent store
+	ACTIVE_QUEUES = [DOWNLOAD_RESOLVING, DOWNLOAD_QUEUE, DOWNLOAD_ACTIVE, DOWNLOAD_POSTPROCESSING, DOWNLOAD_PAUSED]
+
+	def __init__(self, settings: 'IUBConfiguration', logging_handler: 'logging', dm: 'DownloaderManager', store: MemoryQueueStore = None):
 		self.dm = dm
 		self.logging = logging_handler
 		self.configuration = settings
-		self.queues = {
-			'downloadQueue': [],
-			'downloadFailed': [],
-			'inProgress': [],
-			'paused': [],
-			'downloadCompleted': []
-		}
+		# The store containing the files of every queue and the url index
+		self.store = store if store is not None else MemoryQueueStore(self.ALL_QUEUES)
+		self.queueNames = self.store.queue_names()
+		# Scheduler: one FIFO of (sequence, url) per host, the hosts that can start a new download and the active count
+		self.hostQueues = {}
+		self.pendingSeq = {}
+		self.sequence = count()
+		self.activePerHost = {}
+		self.readyHosts = set()
+		self.hostLimits = {}
+		self.maxTotalDownload = self.configuration.get_config('GlobalSettings', 'maxTotalDownload')
+		# Snapshots: a global version, a version for each queue and the last view built for every queue
+		self.instanceId = uuid.uuid4().hex[:8]
+		self.version = 0
+		self.queueVersions = {queue: 0 for queue in self.queueNames}
+		self.queueViews = {}
+		self.snapshot = None
+		# The stream of changes pushed to the clients
+		self.events = EventStream()
+		# The journal storing every change, attached once the history is loaded
+		self.journal = None
+		self.compacting = False
+		# The reservations of disk space, attached by the manager
+		self.diskSpace = None
+		self.spaceCheckInterval = None
+		# The urls held back for disk space, reported once
+		self.waitingForSpace = set()
 		self.queueLock = Condition()
+		self._rebuild_scheduler()
 
 	def get_queues(self) -> dict:
 		"""
 		Return a copy of the current queues
-		:return:
+		:return: The lists of the files in each queue, without the queues read a page at a time.
+		The files are shared with the current snapshot and must not be modified
 		"""
-		return copy.deepcopy(self.queues)
+		return {queue: list(files) for queue, files in self.get_snapshot().queues.items()}
+
+	def get_snapshot(self) -> QueueSnapshot:
+		"""
+		Retrieve the snapshot of the current queues, rebuilding only the queues changed since the last request.
+		The queues read a page at a time are only counted, their files are retrieved with get_page
+		:return: The current snapshot
+		"""
+		with self.queueLock:
+			if self.snapshot is None or self.snapshot.version != self.version:
+				queues = {}
+				counts = {}
+				for queue in self.queueNames:
+					if self.store.is_paged(queue):
+						counts[queue] = self.store.count(queue)
+						continue
+					view = self.queueViews.get(queue)
+					if view is None or view[0] != self.queueVersions[queue]:
+						view = (self.queueVersions[queue], tuple(file.to_dict() for file in self.store.files(queue)))
+						self.queueViews[queue] = view
+					queues[queue] = view[1]
+				self.snapshot = QueueSnapshot(self.instanceId, self.version, self.events.sequence, queues, counts, self.queueNames)
+			return self.snapshot
 
 	def change_queue(self, url: str, source_queue: str, destination_queue: str) -> bool:
 		"""
@@ -47,21 +134,20 @@ class QueueManager:
 		:return: True if the change queue was successful. False if there was an error.
 		"""
 		# Initial check
-		if not all(x in self.queues for x in [source_queue, destination_queue]):
+		if not all(x in self.queueNames for x in [source_queue, destination_queue]):
 			self.logging.error("Invalid queues: " + source_queue + " -> " + destination_queue)
 			return False
 		# File movement
 		with self.queueLock:
-			for idx, el in enumerate(copy.deepcopy(self.queues[source_queue])):
-				if el["url"] == url:
-					self.logging.info("Moving url ["+url+"] from "+source_queue+" to " + destination_queue)
-					self.queues[destination_queue].append(self.queues[source_queue].pop(idx))
-					# A download is completed, check if another file can be downloaded
-					if source_queue == "inProgress":
-						self.queueLock.notify_all()
-					return True
-			self.logging.warning("Cannot find the requested url from the list " + source_queue)
-			return False
+			if self.store.locate(url) != source_queue:
+				self.logging.warning("Cannot find the requested url from the list " + source_queue)
+				return False
+			self.logging.info("Moving url ["+url+"] from "+source_queue+" to " + destination_queue)
+			self._move(url, source_queue, destination_queue)
+			# A download is completed, check if another file can be downloaded
+			if source_queue == "inProgress":
+				self.queueLock.notify_all()
+			return True
 
 	def addBatchFiles(self, batchList: list, destination_queue: str = "downloadQueue") -> bool:
 		"""
@@ -71,32 +157,83 @@ class QueueManager:
 		:return: The append operation outcome
 		"""
 		# Initial check
-		if destination_queue not in self.queues:
+		if destination_queue not in self.queueNames:
 			self.logging.error("Invalid destination queue: " + destination_queue)
 			return False
 		# File movement
 		with self.queueLock:
 			count = 0
 			for file in batchList:
-				url = file['url']
-				if self.already_managing(url):
+				url = file.url
+				if self.store.locate(url) is not None:
 					self.logging.info("Already downloading: [" + url + "] - Skip")
 				else:
-					self.queues[destination_queue].append(file)
+					self._insert(file, destination_queue)
+					fileValues = file.to_dict()
+					self.events.publish('add', {'url': url, 'queue': destination_queue, 'file': fileValues})
+					self._journal({'op': 'add', 'url': url, 'queue': destination_queue, 'file': fileValues})
 					count += 1
 			self.logging.info("Added " + str(count) + " files to queue")
 			# Added a new link, check if it can be downloaded
 			self.queueLock.notify_all()
 			return True
 
-	def get_next_file(self) -> dict:
+	def get_events(self, since: int, timeout: float = None) -> Union[list, None]:
+		"""
+		Retrieve the changes applied to the queues after a certain event
+		:param since: The sequence number of the last event known by the client
+		:param timeout: The maximum time to wait for a new event
+		:return: The list of (sequence, type, data) events. None if the client has to reload the whole snapshot
+		"""
+		return self.events.read(since, timeout)
+
+	def add_resolved_files(self, url: str, files: list) -> bool:
+		"""
+		Add to the download queue some of the files extracted from a requested url that is still being resolved
+		:param url: The requested url
+		:param files: The files extracted from the url
+		:return: False if the request is no longer in the resolving queue (e.g. deleted while resolving)
+		"""
+		with self.queueLock:
+			if self.store.locate(url) != self.DOWNLOAD_RESOLVING:
+				return False
+			return self.addBatchFiles(files)
+
+	def complete_resolution(self, url: str, files: list) -> bool:
+		"""
+		Replace a requested url in the resolving queue with the files to download
+		:param url: The requested url
+		:param files: The files extracted from the url
+		:return: False if the request is no longer in the resolving queue (e.g. deleted while resolving)
+		"""
+		with self.queueLock:
+			if self.store.locate(url) != self.DOWNLOAD_RESOLVING:
+				self.logging.info("Request no longer waiting for resolution [" + url + "] - Discarding " + str(len(files)) + " files")
+				return False
+			self._remove(url, self.DOWNLOAD_RESOLVING)
+			self.events.publish('delete', {'url': url, 'queue': self.DOWNLOAD_RESOLVING})
+			self._journal({'op': 'delete', 'url': url})
+			return self.addBatchFiles(files)
+
+	def get_files(self, queue: str) -> list:
+		"""
+		Retrieve the files in a queue
+		:param queue: The queue name
+		:return: The list of files
+		"""
+		with self.queueLock:
+			return list(self.store.files(queue))
+
+	def get_next_file(self) -> DownloadRecord:
 		"""
 		An infinite loop that continuously tries to retrieve an available url to download
 		:return: The element to download
 		"""
 		with self.queueLock:
 			self.logging.info("Requesting next available file")
-			self.queueLock.wait_for(self._available_url)
+			# The free space may change outside of the queues, it is checked again periodically
+			while not self.queueLock.wait_for(self._available_url, self.spaceCheckInterval):
+				pass
 			return self._get_next_element()
 
 	def already_managing(self, url: str) -> bool:
@@ -106,11 +243,7 @@ class QueueManager:
 		:return: True if the url is already managed, False otherwise
 		"""
 		with self.queueLock:
-			for queue in self.queues:
-				for el in self.queues[queue]:
-					if el['url'] == url:
-						return True
-			return False
+			return self.store.locate(url) is not None
 
 	def delete_from_queue(self, url: str) -> bool:
 		"""
@@ -119,12 +252,11 @@ class QueueManager:
 		:return: True if the file is successfully removed
 		"""
 		with self.queueLock:
-			relevantQueues = list(self.queues.keys())
-			relevantQueues.remove(self.DOWNLOAD_ACTIVE)
+			relevantQueues = [queue for queue in self.queueNames if queue != self.DOWNLOAD_ACTIVE]
 			file, queue = self.retrieveFileFromUrl(url, relevantQueues)
 			return self.delete_file_from_queue(file, queue)
 
-	def delete_file_from_queue(self, file: dict, queue: str) -> bool:
+	def delete_file_from_queue(self, file: DownloadRecord, queue: str) -> bool:
 		"""
 		Delete a certain file from a queue
 		:param file: The file to delete
@@ -132,8 +264,10 @@ class QueueManager:
 		:return: The deletion outcome
 		"""
 		with self.queueLock:
-			if file:
-				self.queues[queue].remove(file)
+			if file and self.store.locate(file.url) == queue:
+				self._remove(file.url, queue)
+				self.events.publish('delete', {'url': file.url, 'queue': queue})
+				self._journal({'op': 'delete', 'url': file.url})
 				return True
 			else:
 				#Element not found
@@ -144,50 +278,355 @@ class QueueManager:
 		Extract the file and the queue name where the file is located
 		:param url: The url to find
 		:param relevantQueues: The queues where the file will bea searched
-		:return: The file and the queue
+		:return: The file and the queue. None, None if the url is not in the relevant queues
+		"""
+		with self.queueLock:
+			file, queue = self.store.get(url)
+			if queue in relevantQueues:
+				return file, queue
+			return None, None
+
+	def update_download_progress(self, progress: dict):
+		"""
+		Update the download status of the active files
+		:param progress: A dictionary associating the url to its current download percentage
+		:return:
+		"""
+		with self.queueLock:
+			for url, percentage in progress.items():
+				file, queue = self.store.get(url)
+				if queue == self.DOWNLOAD_ACTIVE:
+					if self.diskSpace:
+						self.diskSpace.progress(url, percentage)
+					file.status = percentage
+					self.store.update(file)
+					self._touch(self.DOWNLOAD_ACTIVE)
+					self.events.publish('progress', {'url': url, 'status': percentage})
+					self._journal({'op': 'progress', 'url': url, 'status': percentage})
+
+	def update_partial(self, url: str, partial: dict):
+		"""
+		Store the state of a partially downloaded file, used to resume its download
+		:param url: The url of the file
+		:param partial: The resume state. None to drop it
+		:return:
+		"""
+		with self.queueLock:
+			file, queue = self.store.get(url)
+			if file is None or (file.partial is None and partial is None):
+				return
+			file.partial = partial
+			self.store.update(file)
+			self._journal({'op': 'partial', 'url': url, 'partial': partial})
+
+	def reserve_space(self, url: str, size: int) -> bool:
+		"""
+		Reserve the disk space still needed by an active download, storing the size to admit the file again if it does not fit
+		:param url: The url of the file
+		:param size: The bytes that will be written. 0 once they are allocated on disk
+		:return: False if the file does not fit in the free space
+		"""
+		with self.queueLock:
+			file, queue = self.store.get(url)
+			if queue != self.DOWNLOAD_ACTIVE:
+				return True
+			# Once allocated, a paused or restarted download needs no further space to be admitted again
+			expectedSize = size or None
+			if file.size != expectedSize:
+				file.size = expectedSize
+				self.store.update(file)
+				self._journal({'op': 'size', 'url': url, 'size': expectedSize})
+			if self.diskSpace is None:
+				return True
+			return self.diskSpace.reserve(url, file.host, size)
+
+	def _touch(self, queue: str):
+		"""
+		Mark a queue as changed, invalidating the current snapshot - Must be called holding the queue lock
+		:param queue: The changed queue
+		:return:
+		"""
+		self.version += 1
+		self.queueVersions[queue] += 1
+
+	def _insert(self, file: DownloadRecord, queue: str):
+		"""
+		Append a file to a queue and register it in the url index - Must be called holding the queue lock
+		:param file: The file to append
+		:param queue: The destination queue
+		:return:
+		"""
+		self.store.insert(file, queue)
+		self._track_insert(file, queue)
+
+	def _track_insert(self, file: DownloadRecord, queue: str):
+		"""
+		Update the versions and the scheduler after a file entered a queue - Must be called holding the queue lock
+		:param file: The inserted file
+		:param queue: The destination queue
+		:return:
+		"""
+		url = file.url
+		self._touch(queue)
+		if queue == self.DOWNLOAD_QUEUE:
+			seq = next(self.sequence)
+			self.pendingSeq[url] = seq
+			self.hostQueues.setdefault(file.host, deque()).append((seq, url))
+			self._refresh_host(file.host)
+		elif queue == self.DOWNLOAD_ACTIVE:
+			host = file.host
+			self.activePerHost[host] = self.activePerHost.get(host, 0) + 1
+			self._refresh_host(host)
+			if self.diskSpace and file.size:
+				# Admitted because it fits, the space is held until it leaves the active queue
+				self.diskSpace.hold(url, host, file.size)
+
+	def _remove(self, url: str, queue: str) -> DownloadRecord:
+		"""
+		Remove a file from a queue and from the url index - Must be called holding the queue lock
+		:param url: The url of the file to remove
+		:param queue: The queue where the file is located
+		:return: The removed file
+		"""
+		file = self.store.remove(url, queue)
+		self._track_remove(file, queue)
+		return file
+
+	def _track_remove(self, file: DownloadRecord, queue: str):
+		"""
+		Update the versions and the scheduler after a file left a queue - Must be called holding the queue lock
+		:param file: The removed file
+		:param queue: The source queue
+		:return:
+		"""
+		url = file.url
+		self._touch(queue)
+		if queue == self.DOWNLOAD_QUEUE:
+			# The entry in the host FIFO is discarded lazily
+			del self.pendingSeq[url]
+			self._refresh_host(file.host)
+		elif queue == self.DOWNLOAD_ACTIVE:
+			host = file.host
+			self.activePerHost[host] -= 1
+			if not self.activePerHost[host]:
+				del self.activePerHost[host]
+			self._refresh_host(host)
+			if self.diskSpace:
+				self.diskSpace.release(url)
+
+	def _move(self, url: str, source_queue: str, destination_queue: str) -> DownloadRecord:
+		"""
+		Move a file at the end of another queue - Must be called holding the queue lock
+		:param url: The url of the file to move
+		:param source_queue: The queue where the file is located
+		:param destination_queue: The queue where the file will be placed
+		:return: The moved file
+		"""
+		# A single change in the store, so that a crash cannot lose the file between the two queues
+		file = self.store.move(url, source_queue, destination_queue)
+		self._track_remove(file, source_queue)
+		self._track_insert(file, destination_queue)
+		self.events.publish('move', {'url': url, 'source': source_queue, 'queue': destination_queue, 'file': file.to_dict()})
+		self._journal({'op': 'move', 'url': url, 'queue': destination_queue})
+		return file
+
+	def restore(self, queues: dict) -> int:
+		"""
+		Install the content of the queues in a single step, used to load the history
+		:param queues: A dictionary associating each queue to its list of files
+		:return: The number of restored files
 		"""
 		with self.queueLock:
-			for queue in relevantQueues:
-				for file in self.queues[queue]:
-					if file["url"] == url:
-						return file, queue
+			seen = set()
+			checkStore = not self.store.is_empty()
+			restored = 0
+			for queue, files in queues.items():
+				if queue not in self.queueNames:
+					self.logging.error("Invalid destination queue: " + queue + " - Skipping " + str(len(files)) + " files")
+					continue
+				batch = []
+				for file in files:
+					if file.url in seen or (checkStore and self.store.locate(file.url) is not None):
+						self.logging.info("Already downloading: [" + file.url + "] - Skip")
+						continue
+					seen.add(file.url)
+					batch.append(file)
+				self.store.insert_batch(batch, queue)
+				if self.journal:
+					for file in batch:
+						self._journal({'op': 'add', 'url': file.url, 'queue': queue, 'file': file.to_dict()})
+				self._touch(queue)
+				restored += len(batch)
+			self._rebuild_scheduler()
+			self.logging.info("Restored " + str(restored) + " files")
+			self.queueLock.notify_all()
+			return restored
+
+	def requeue_active(self):
+		"""
+		Move the files left active or waiting for post processing by a previous run at the beginning of the download queue
+		:return:
+		"""
+		with self.queueLock:
+			for queue in [self.DOWNLOAD_POSTPROCESSING, self.DOWNLOAD_ACTIVE]:
+				urls = [file.url for file in self.store.files(queue)]
+				if urls:
+					self.store.move_to_front(urls, queue, self.DOWNLOAD_QUEUE)
+					if self.diskSpace:
+						for url in urls:
+							self.diskSpace.release(url)
+					self._touch(queue)
+					self._touch(self.DOWNLOAD_QUEUE)
+					self._rebuild_scheduler()
+					self.logging.info("Restored " + str(len(urls)) + " files of " + queue + " in the download queue")
+					self.queueLock.notify_all()
+
+	def get_page(self, queue: str, offset: int, limit: int) -> Union[list, None]:
+		"""
+		Retrieve a portion of a queue
+		:param queue: The queue name
+		:param offset: The number of files to skip
+		:param limit: The maximum number of files to return
+		:return: The files as dictionaries. None if the queue does not exist
+		"""
+		if queue not in self.queueNames:
 			return None
+		with self.queueLock:
+			return [file.to_dict() for file in self.store.page(queue, offset, limit)]
+
+	def get_counts(self) -> dict:
+		"""
+		Count the files in each queue
+		:return: A dictionary associating each queue to its size
+		"""
+		with self.queueLock:
+			return {queue: self.store.count(queue) for queue in self.queueNames}
+
+	def attach_disk_space(self, monitor: 'DiskSpaceMonitor', checkInterval: float):
+		"""
+		Admit a file only when its expected size fits in the free disk space
+		:param monitor: The reservations of disk space
+		:param checkInterval: The seconds after which a file waiting for space is checked again
+		:return:
+		"""
+		with self.queueLock:
+			self.diskSpace = monitor
+			self.spaceCheckInterval = checkInterval
+			for file in self.store.files(self.DOWNLOAD_ACTIVE):
+				if file.size:
+					monitor.hold(file.url, file.host, file.size)
+
+	def attach_journal(self, journal: 'QueueJournal'):
+		"""
+		Start storing every change of the queues in the journal
+		:param journal: The journal
+		:return:
+		"""
+		with self.queueLock:
+			self.journal = journal
+
+	def rotate_journal(self) -> tuple:
+		"""
+		Take a snapshot of the queues and start a new journal, so that the snapshot and the new journal contain every change
+		:return: The snapshot and the path of the rotated journal to delete once the snapshot is stored (None if there is no journal)
+		"""
+		with self.queueLock:
+			rotated = self.journal.rotate() if self.journal else None
+			return self.get_snapshot(), rotated
 
-	def update_download_progress(self, url: str, percentage: float):
+	def compaction_completed(self):
 		"""
-		Update the download status of a certain file
-		:param url: The file to update
-		:param percentage: The current download percentage
+		Mark the running compaction as completed
 		:return:
 		"""
 		with self.queueLock:
-			for file in self.queues['inProgress']:
-				if file["url"] == url:
-					file["status"] = percentage
-					return
+			self.compacting = False
 
-	def _get_queue_overview(self, queue: str = 'inProgress'):
+	def _journal(self, operation: dict):
+		"""
+		Store a change in the journal, starting a compaction when the journal is too long - Must be called holding the queue lock
+		:param operation: The change to store
+		:return:
 		"""
-		Retrieve an overview of the host in the current queue
-		:return: A dictionary containing the count of the elements in the queue
+		if self.journal is None:
+			return
+		self.journal.append(operation)
+		if not self.compacting and self.journal.needs_compaction():
+			self.compacting = True
+			threading.Thread(target=self._compact, daemon=True).start()
+
+	def _compact(self):
 		"""
-		overview = {}
-		for el in self.queues[queue]:
-			if el['host'] in overview:
-				overview[el['host']] += 1
+		Store a new snapshot in background, the next compaction can start only once this one ends
+		:return:
+		"""
+		try:
+			self.dm.saveHistory()
+		except BaseException as e:
+			self.logging.error("Cannot compact the journal: " + str(e))
+		finally:
+			self.compaction_completed()
+
+	def _rebuild_scheduler(self):
+		"""
+		Rebuild the host FIFOs and the active counters from the content of the store - Must be called holding the queue lock
+		:return:
+		"""
+		self.hostQueues = {}
+		self.pendingSeq = {}
+		self.activePerHost = {}
+		self.readyHosts = set()
+		for file in self.store.files(self.DOWNLOAD_ACTIVE):
+			self.activePerHost[file.host] = self.activePerHost.get(file.host, 0) + 1
+		for file in self.store.files(self.DOWNLOAD_QUEUE):
+			seq = next(self.sequence)
+			self.pendingSeq[file.url] = seq
+			self.hostQueues.setdefault(file.host, deque()).append((seq, file.url))
+		for host in list(self.hostQueues):
+			self._refresh_host(host)
+
+	def _get_host_limit(self, host: str) -> Union[int, None]:
+		"""
+		Retrieve the maximum number of simultaneous downloads for a host, caching the settings lookup
+		:param host: The host to check
+		:return: The limit for this host. None if the host has no limit
+		"""
+		if host not in self.hostLimits:
+			if host is None:
+				self.logging.warning("Missing information on host - Skipping host limitation")
+				self.hostLimits[host] = None
 			else:
-				overview[el['host']] = 1
-		return overview
+				sectionName = self.dm.extractSettingsAssociation(host)['settingsSectionName']
+				self.hostLimits[host] = self.configuration.get_config(sectionName, 'maxDownloadPerHost')
+		return self.hostLimits[host]
 
-	def _get_next_element(self) -> Union[dict, None]:
+	def _refresh_host(self, host: str):
+		"""
+		Discard the stale entries on top of the host FIFO and update the set of hosts that can start a download
+		:param host: The host to refresh
+		:return:
+		"""
+		fifo = self.hostQueues.get(host)
+		while fifo and self.pendingSeq.get(fifo[0][1]) != fifo[0][0]:
+			fifo.popleft()
+		if not fifo:
+			self.hostQueues.pop(host, None)
+			self.readyHosts.discard(host)
+			return
+		limit = self._get_host_limit(host)
+		if limit is None or self.activePerHost.get(host, 0) < limit:
+			self.readyHosts.add(host)
+		else:
+			self.readyHosts.discard(host)
+
+	def _get_next_element(self) -> Union[DownloadRecord, None]:
 		"""
 		Retrieves the first available element from the download queue
 		:return: The element to download. None in case of errors
 		"""
 		try:
-			index = self._get_index_first_element_available()
-			el = self.queues['downloadQueue'].pop(index)
-			self.queues['inProgress'].append(el)
+			url = self._get_first_element_available()
+			el = self._move(url, 'downloadQueue', 'inProgress')
 			self.logging.info("Downloading: " + str(el))
 			return el
 		except NoElementAvailable:
@@ -200,34 +639,39 @@ class QueueManager:
 		:return: True if there is at least one link that can be processed. False otherwise.
 		"""
 		# Check if there are any further link to download
-		if len(self.queues['downloadQueue']) == 0:
+		if self.store.count(self.DOWNLOAD_QUEUE) == 0:
 			return False
 		# Check if limits of simultaneous download has been reached
-		if len(self.queues['inProgress']) >= self.configuration.get_config('GlobalSettings', 'maxTotalDownload'):
+		if self.store.count(self.DOWNLOAD_ACTIVE) >= self.maxTotalDownload:
 			return False
 		# Check max count per host
 		try:
-			self._get_index_first_element_available()
+			self._get_first_element_available()
 			return True
 		except NoElementAvailable:
 			return False
 
-	def _get_index_first_element_available(self) -> int:
+	def _get_first_element_available(self) -> str:
 		"""
 		Check if there is at least one host that can be processed in the download queue
-		:return: The index containing the first available element. Raise NoElementAvailable if no element is found
-		"""
-		queue_overview = self._get_queue_overview()
-		for idx, el in enumerate(copy.deepcopy(self.queues['downloadQueue'])):
-			if 'host' not in el:
-				self.logging.warning("Missing information on host in this object [" + str(el) + "] - Skipping host limitation")
-				return idx
-			# This host is not in the download list, proceed
-			if el['host'] not in queue_overview:
-				self.logging.info("File not in logging overview")
-				return idx
-			# This host has not reached the global limit per host
-			sectionName = self.dm.extractSettingsAssociation(el['host'])['settingsSectionName']
-			if queue_overview.get(el['host']) < self.configuration.get_config(sectionName, 'maxDownloadPerHost'):
-				return idx
+		:return: The url of the first available element. Raise NoElementAvailable if no element is found
+		"""
+		# Among the hosts below their limit, pick the oldest file
+		if not self.readyHosts:
+			raise NoElementAvailable()
+		if self.diskSpace is None:
+			host = min(self.readyHosts, key=lambda h: self.hostQueues[h][0][0])
+			return self.hostQueues[host][0][1]
+		# Skip the files that do not fit in the free space, the other hosts can proceed
+		for host in sorted(self.readyHosts, key=lambda h: self.hostQueues[h][0][0]):
+			url = self.hostQueues[host][0][1]
+			size = self.store.get(url)[0].size or 0
+			if self.diskSpace.fits(host, size):
+				self.waitingForSpace.discard(url)
+				return url
+			if url not in self.waitingForSpace:
+				self.waitingForSpace.add(url)
+				self.logging.warning("Not enough free space for " + str(size) + " bytes - Download deferred [" + url + "]")
+		# Forget the files no longer waiting at the head of their host
+		self.waitingForSpace &= {fifo[0][1] for fifo in self.hostQueues.values() if fifo}
 		raise NoElementAvailable()
@@ -0,0 +1,297 @@
+from __future__ import annotations
+import json
+import logging
+import sqlite3
+from itertools import islice
+from threading import RLock
+from typing import Iterable, Union
+from DownloadRecord import DownloadRecord
+
+
+class MemoryQueueStore:
+	"""
+	Keeps every queue in memory: each queue maps the url to its file, keeping the insertion order
+	"""
+
+	def __init__(self, queueNames: list):
+		self.queues = {queue: {} for queue in queueNames}
+		# Url index: maps every managed url to the queue where it is currently located
+		self.urlIndex = {}
+
+	def queue_names(self) -> list:
+		return list(self.queues)
+
+	def locate(self, url: str) -> Union[str, None]:
+		"""
+		Find the queue containing a url
+		:param url: The url to find
+		:return: The queue name. None if the url is not managed
+		"""
+		return self.urlIndex.get(url)
+
+	def get(self, url: str) -> tuple:
+		"""
+		Retrieve a file and the queue where it is located
+		:param url: The url to find
+		:return: The file and the queue. None, None if the url is not managed
+		"""
+		queue = self.urlIndex.get(url)
+		if queue is None:
+			return None, None
+		return self.queues[queue][url], queue
+
+	def insert(self, file: DownloadRecord, queue: str):
+		"""
+		Append a file at the end of a queue
+		:param file: The file to append
+		:param queue: The destination queue
+		:return:
+		"""
+		self.queues[queue][file.url] = file
+		self.urlIndex[file.url] = queue
+
+	def insert_batch(self, files: list, queue: str):
+		"""
+		Append a list of files, that are not already managed, at the end of a queue
+		:param files: The files to append
+		:param queue: The destination queue
+		:return:
+		"""
+		for file in files:
+			self.insert(file, queue)
+
+	def remove(self, url: str, queue: str) -> DownloadRecord:
+		"""
+		Remove a file from a queue
+		:param url: The url of the file to remove
+		:param queue: The queue where the file is located
+		:return: The removed file
+		"""
+		del self.urlIndex[url]
+		return self.queues[queue].pop(url)
+
+	def move(self, url: str, source_queue: str, destination_queue: str) -> DownloadRecord:
+		"""
+		Move a file at the end of another queue
+		:param url: The url of the file to move
+		:param source_queue: The queue where the file is located
+		:param destination_queue: The queue where the file will be placed
+		:return: The moved file
+		"""
+		file = self.remove(url, source_queue)
+		self.insert(file, destination_queue)
+		return file
+
+	def move_to_front(self, urls: list, source_queue: str, destination_queue: str):
+		"""
+		Move some files at the beginning of another queue, keeping their order
+		:param urls: The urls of the files to move
+		:param source_queue: The queue where the files are located
+		:param destination_queue: The queue where the files will be placed
+		:return:
+		"""
+		moved = {url: self.remove(url, source_queue) for url in urls}
+		moved.update(self.queues[destination_queue])
+		self.queues[destination_queue] = moved
+		for url in moved:
+			self.urlIndex[url] = destination_queue
+
+	def update(self, file: DownloadRecord):
+		"""
+		Store the changes applied to a file - The files are kept in memory, nothing to do
+		:param file: The changed file
+		:return:
+		"""
+		pass
+
+	def count(self, queue: str) -> int:
+		return len(self.queues[queue])
+
+	def is_paged(self, queue: str) -> bool:
+		"""
+		Check if a queue is too large to be read at once and must be read a page at a time
+		:param queue: The queue name
+		:return: True if the queue is not kept in memory
+		"""
+		return False
+
+	def files(self, queue: str) -> Iterable[DownloadRecord]:
+		"""
+		Iterate over the files of a queue, in order
+		:param queue: The queue name
+		:return: The files
+		"""
+		return iter(list(self.queues[queue].values()))
+
+	def page(self, queue: str, offset: int, limit: int) -> list:
+		"""
+		Retrieve a portion of a queue
+		:param queue: The queue name
+		:param offset: The number of files to skip
+		:param limit: The maximum number of files to return
+		:return: The files
+		"""
+		return list(islice(self.queues[queue].values(), offset, offset + limit))
+
+	def is_empty(self) -> bool:
+		return not self.urlIndex
+
+	def close(self):
+		pass
+
+
+class SqliteQueueStore(MemoryQueueStore):
+	"""
+	Keeps every file in a SQLite database, indexed on url, queue and host.
+	Only the files waiting, active or paused are also kept in memory, so the memory does not grow with the history.
+	"""
+
+	def __init__(self, path: str, queueNames: list, memoryQueues: list, logging_handler: 'logging'):
+		super().__init__(memoryQueues)
+		self.allQueues = list(queueNames)
+		self.logging = logging_handler
+		self.lock = RLock()
+		self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS files ("
+			"url TEXT PRIMARY KEY, queue TEXT NOT NULL, position INTEGER NOT NULL, "
+			"host TEXT, name TEXT, status REAL, extra TEXT)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS files_queue ON files (queue, position)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS files_queue_host ON files (queue, host, position)")
+		row = self.connection.execute("SELECT MIN(position), MAX(position) FROM files").fetchone()
+		self.firstPosition = row[0] if row[0] is not None else 0
+		self.nextPosition = row[1] + 1 if row[1] is not None else 0
+		# Load the files kept in memory
+		for queue in memoryQueues:
+			for file in self._select("WHERE queue = ? ORDER BY position", (queue,)):
+				super().insert(file, queue)
+		self.logging.info("Opened queue database [" + path + "]")
+
+	def queue_names(self) -> list:
+		return list(self.allQueues)
+
+	def locate(self, url: str) -> Union[str, None]:
+		queue = super().locate(url)
+		if queue is not None:
+			return queue
+		with self.lock:
+			row = self.connection.execute("SELECT queue FROM files WHERE url = ?", (url,)).fetchone()
+		return row[0] if row else None
+
+	def get(self, url: str) -> tuple:
+		file, queue = super().get(url)
+		if file is not None:
+			return file, queue
+		with self.lock:
+			row = self.connection.execute("SELECT url, queue, host, name, status, extra FROM files WHERE url = ?", (url,)).fetchone()
+		if row is None:
+			return None, None
+		return self._to_record(row), row[1]
+
+	def insert(self, file: DownloadRecord, queue: str):
+		with self.lock:
+			self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", self._to_row(file, queue, self.nextPosition))
+			self.nextPosition += 1
+		if queue in self.queues:
+			super().insert(file, queue)
+
+	def insert_batch(self, files: list, queue: str):
+		with self.lock:
+			rows = [self._to_row(file, queue, self.nextPosition + idx) for idx, file in enumerate(files)]
+			self.nextPosition += len(rows)
+			self.connection.execute("BEGIN")
+			self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+			self.connection.execute("COMMIT")
+		if queue in self.queues:
+			super().insert_batch(files, queue)
+
+	def remove(self, url: str, queue: str) -> DownloadRecord:
+		if queue in self.queues:
+			file = super().remove(url, queue)
+		else:
+			file, queue = self.get(url)
+		with self.lock:
+			self.connection.execute("DELETE FROM files WHERE url = ?", (url,))
+		return file
+
+	def move(self, url: str, source_queue: str, destination_queue: str) -> DownloadRecord:
+		if source_queue in self.queues:
+			file = super().remove(url, source_queue)
+		else:
+			file = self.get(url)[0]
+		with self.lock:
+			# The queue and the position change in a single transaction
+			self.connection.execute("BEGIN")
+			try:
+				self.connection.execute("UPDATE files SET queue = ?, position = ? WHERE url = ?", (destination_queue, self.nextPosition, url))
+				self.connection.execute("COMMIT")
+			except BaseException:
+				self.connection.execute("ROLLBACK")
+				raise
+			self.nextPosition += 1
+		if destination_queue in self.queues:
+			super().insert(file, destination_queue)
+		return file
+
+	def move_to_front(self, urls: list, source_queue: str, destination_queue: str):
+		with self.lock:
+			self.connection.execute("BEGIN")
+			for idx, url in enumerate(urls):
+				position = self.firstPosition - len(urls) + idx
+				self.connection.execute("UPDATE files SET queue = ?, position = ? WHERE url = ?", (destination_queue, position, url))
+			self.connection.execute("COMMIT")
+			self.firstPosition -= len(urls)
+		super().move_to_front(urls, source_queue, destination_queue)
+
+	def update(self, file: DownloadRecord):
+		with self.lock:
+			row = self._to_row(file, None, None)
+			self.connection.execute("UPDATE files SET host = ?, name = ?, status = ?, extra = ? WHERE url = ?", row[3:] + (file.url,))
+
+	def count(self, queue: str) -> int:
+		if queue in self.queues:
+			return super().count(queue)
+		with self.lock:
+			return self.connection.execute("SELECT COUNT(*) FROM files WHERE queue = ?", (queue,)).fetchone()[0]
+
+	def is_paged(self, queue: str) -> bool:
+		return queue not in self.queues
+
+	def files(self, queue: str) -> Iterable[DownloadRecord]:
+		if queue in self.queues:
+			return super().files(queue)
+		return iter(self._select("WHERE queue = ? ORDER BY position", (queue,)))
+
+	def page(self, queue: str, offset: int, limit: int) -> list:
+		if queue in self.queues:
+			return super().page(queue, offset, limit)
+		return self._select("WHERE queue = ? ORDER BY position LIMIT ? OFFSET ?", (queue, limit, offset))
+
+	def is_empty(self) -> bool:
+		with self.lock:
+			return self.connection.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+	def _select(self, condition: str, parameters: tuple) -> list:
+		with self.lock:
+			rows = self.connection.execute("SELECT url, queue, host, name, status, extra FROM files " + condition, parameters).fetchall()
+		return [self._to_record(row) for row in rows]
+
+	@staticmethod
+	def _to_row(file: DownloadRecord, queue: Union[str, None], position: Union[int, None]) -> tuple:
+		values = file.to_dict()
+		for key in ['url', 'name', 'host', 'status']:
+			values.pop(key, None)
+		extra = json.dumps(values) if values else None
+		return file.url, queue, position, file.host, file.name, file.status, extra
+
+	@staticmethod
+	def _to_record(row: tuple) -> DownloadRecord:
+		values = json.loads(row[5]) if row[5] else {}
+		values.update({'url': row[0], 'host': row[2], 'name': row[3], 'status': row[4]})
+		return DownloadRecord.from_dict(values)
@@ -0,0 +1,63 @@
+from __future__ import annotations
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from DownloadRecord import DownloadRecord
+from QueueManager import QueueManager
+
+
+class UrlResolver:
+	"""
+	Resolves the requested urls into the files to download, using a bounded pool of workers.
+	While waiting for resolution a request is kept in the resolving queue.
+	"""
+
+	def __init__(self, dm: 'DownloaderManager', logging_handler: 'logging', workers: int, pageSize: int = 50):
+		self.dm = dm
+		self.logging = logging_handler
+		# The files are moved to the download queue in pages, while the rest of the url is still being resolved
+		self.pageSize = pageSize
+		self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="resolver")
+
+	def submit(self, request: DownloadRecord):
+		"""
+		Schedule the resolution of a requested url
+		:param request: The record placed in the resolving queue
+		:return:
+		"""
+		self.executor.submit(self._resolve, request)
+
+	def _resolve(self, request: DownloadRecord):
+		"""
+		Extract the files to download from a requested url and move them to the download queue
+		:param request: The record placed in the resolving queue
+		:return:
+		"""
+		url = request.url
+		try:
+			downloader = self.dm.get_downloader(url)
+			el = downloader.get_info(url)
+			if isinstance(el, dict) and 'dir_value' in el:
+				files = iter(el['dir_value'])
+			else:
+				files = iter([el])
+			count = 0
+			# A file with the requested url (a single video) can only replace the request once the resolution is complete
+			own = []
+			while True:
+				page = list(islice(files, self.pageSize))
+				if not page:
+					break
+				count += len(page)
+				own += [file for file in page if file.url == url]
+				page = [file for file in page if file.url != url]
+				# Each page is queued as soon as it is listed, the downloads start while the next one is requested
+				if page and not self.dm.queueManager.add_resolved_files(url, page):
+					self.logging.info("Stopping resolution of [" + url + "]")
+					return
+			self.dm.queueManager.complete_resolution(url, own)
+			self.logging.info("Resolved url [" + url + "] into " + str(count) + " files")
+		except BaseException as e:
+			self.logging.warning("Cannot resolve url [" + url + "]: " + str(e))
+			print("Cannot resolve url [" + url + "]: " + str(e))
+			self.dm.queueManager.change_queue(url, QueueManager.DOWNLOAD_RESOLVING, QueueManager.DOWNLOAD_FAILED)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the download of a Crunchyroll episode: the previous flow (two extractions, serial subtitle download,
+yt-dlp merge and a second ffmpeg rewrite) against the single pass of CrunchyrollDownloader.
+The CrunchyrollSettings section of Settings/settings.yml is used when available (e.g. the account cookies),
+the episode is downloaded in a temporary directory.
+Usage: python benchmarks/bench_crunchyroll.py <episode url>
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+from urllib.parse import urlparse
+
+import yaml
+import yt_dlp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from DownloadRecord import DownloadRecord
+from Downloaders.CrunchyrollDownloader import CrunchyrollDownloader
+from HttpSessionPool import HttpSessionPool
+from MetadataCache import MetadataCache
+
+SECTION = 'CrunchyrollSettings'
+
+
+class BenchConfiguration:
+
+	def __init__(self, section: dict):
+		self.section = section
+
+	def get_config(self, section, key=None):
+		return self.section if key is None else self.section[key]
+
+
+class BenchDownloaderManager:
+	"""
+	Runs the post processing immediately and records the outcome of the download
+	"""
+
+	def __init__(self):
+		# Nothing is cached, both flows extract the episode
+		self.metadataCache = MetadataCache(logging, 0)
+		self.httpPool = HttpSessionPool(logging)
+		self.outcome = None
+
+	def extractSettingsAssociationFromDownloaderName(self, name):
+		return {'settingsSectionName': SECTION}
+
+	def get_optional_config(self, section, key, default):
+		return default
+
+	def registerDownloader(self, url, downloader):
+		return 0
+
+	def update_download_progress(self, downloadId, percentage):
+		pass
+
+	def save_download_state(self, file, partial):
+		pass
+
+	def reserve_disk_space(self, file, size):
+		return True
+
+	def locate_download(self, file):
+		return 'inProgress'
+
+	def post_process_this_download(self, file, job, finalize):
+		finalize(file, job(lambda: None))
+
+	def complete_this_download(self, file, source_queue=None):
+		self.outcome = "complete"
+
+	def finalize_this_download(self, file, source, destination, source_queue=None):
+		self.outcome = "complete"
+
+	def pause_this_download(self, file):
+		self.outcome = "pause"
+
+	def defer_this_download(self, file):
+		self.outcome = "defer"
+
+	def fail_this_download(self, file, source_queue=None):
+		self.outcome = "fail"
+
+
+def load_settings(directory: str) -> dict:
+	settingsPath = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'Settings', 'settings.yml')
+	section = {'outtmpl': '%(title)s.%(ext)s', 'subtitleslangs': ['itIT'], 'quiet': True}
+	if os.path.isfile(settingsPath):
+		with open(settingsPath, 'r') as f:
+			section.update(yaml.safe_load(f).get(SECTION) or {})
+	# Written in the temporary directory, directly in its final location
+	section['outtmpl'] = os.path.join(directory, os.path.basename(section['outtmpl']))
+	section.pop('tempDir', None)
+	return section
+
+
+def previous_flow(downloader: CrunchyrollDownloader, dm: BenchDownloaderManager, url: str):
+	"""
+	The flow replaced by the single pass: an extraction for the subtitle, a serial subtitle download,
+	a second extraction downloading and merging the formats, a rewrite of the merged file with the subtitle
+	"""
+	lang = downloader.options['subtitleslangs'][0]
+	options = {'writesubtitles': True, 'skip_download': True, 'outtmpl': downloader.options['outtmpl'], 'subtitleslangs': downloader.options['subtitleslangs']}
+	with yt_dlp.YoutubeDL(options) as ydl:
+		info_dict = ydl.extract_info(url, download=False)
+		videoName = ydl.prepare_filename(info_dict)
+		sub_ext_info = info_dict.get('subtitles', {}).get(lang[:2] + "-" + lang[2:], [{}])[0]
+		subtitleName = None
+		if sub_ext_info.get('ext') and sub_ext_info.get('url'):
+			subtitleName = os.path.splitext(videoName)[0] + "." + lang + "." + sub_ext_info['ext']
+			urllib.request.urlretrieve(sub_ext_info['url'], subtitleName)
+	with yt_dlp.YoutubeDL(downloader.options) as ydl:
+		info_dict = ydl.extract_info(url, download=True)
+		videoName = ydl.prepare_filename(info_dict)
+	if subtitleName:
+		downloader.joinVideo(videoName, subtitleName, lang, os.path.splitext(videoName)[0] + ".mkv", lambda: None)
+
+
+def single_pass(downloader: CrunchyrollDownloader, dm: BenchDownloaderManager, url: str):
+	downloader.run()
+	if dm.outcome != "complete":
+		raise RuntimeError("Download ended with outcome: " + str(dm.outcome))
+
+
+def measure(label: str, function):
+	start = time.perf_counter()
+	result = function()
+	print("%-40s %8.3f s" % (label, time.perf_counter() - start))
+	return result
+
+
+def main():
+	if len(sys.argv) < 2:
+		print(__doc__)
+		sys.exit(1)
+	url = sys.argv[1]
+	logging.basicConfig(level=logging.WARNING)
+	print("Episode [" + url + "]")
+	for label, flow in [("Previous flow", previous_flow), ("Single pass", single_pass)]:
+		with tempfile.TemporaryDirectory() as directory:
+			dm = BenchDownloaderManager()
+			downloader = CrunchyrollDownloader(BenchConfiguration(load_settings(directory)), logging, dm)
+			downloader.process_download(DownloadRecord(url, url, urlparse(url).netloc))
+			measure(label, lambda: flow(downloader, dm, url))
+			written = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+			print("%-40s %8.1f MiB" % ("  files left in the directory", written / 1024 / 1024))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the history loading: parsing of the snapshot formats and installation of the files in the queues.
+Usage: python benchmarks/bench_history.py [number of files]
+"""
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from DownloadRecord import DownloadRecord
+from QueueManager import QueueManager
+
+
+class BenchConfiguration:
+
+	def get_config(self, section, key=None):
+		return {'maxTotalDownload': 3, 'maxDownloadPerHost': 2}[key]
+
+
+class BenchDownloaderManager:
+
+	def extractSettingsAssociation(self, domain):
+		return {'settingsSectionName': 'GlobalSettings'}
+
+
+def create_history(size: int) -> dict:
+	hosts = ['youtube.com', 'aniplay.it', 'crunchyroll.com']
+	history = {queue: [] for queue in QueueManager.ALL_QUEUES}
+	for idx in range(size):
+		queue = QueueManager.DOWNLOAD_COMPLETED if idx % 10 else QueueManager.DOWNLOAD_QUEUE
+		history[queue].append({'url': 'https://' + hosts[idx % 3] + '/video/' + str(idx), 'name': 'Video ' + str(idx), 'host': hosts[idx % 3], 'status': 100.0})
+	return history
+
+
+def measure(label: str, function):
+	start = time.perf_counter()
+	result = function()
+	print("%-40s %8.3f s" % (label, time.perf_counter() - start))
+	return result
+
+
+def main():
+	size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	logging.disable(logging.CRITICAL)
+	history = create_history(size)
+	print("History of " + str(size) + " files")
+	with tempfile.TemporaryDirectory() as directory:
+		yamlPath = os.path.join(directory, 'history.yml')
+		jsonPath = os.path.join(directory, 'history.jsonl')
+		with open(yamlPath, 'w') as f:
+			yaml.safe_dump(history, f)
+		with open(jsonPath, 'w') as f:
+			for queue, files in history.items():
+				for file in files:
+					f.write(json.dumps(dict(file, queue=queue)) + "\n")
+
+		def load_yaml(loader):
+			with open(yamlPath, 'r') as f:
+				return yaml.load(f, Loader=loader)
+
+		def load_json_lines():
+			rawList = {}
+			with open(jsonPath, 'r') as f:
+				for line in f:
+					file = json.loads(line)
+					rawList.setdefault(file.pop('queue'), []).append(file)
+			return rawList
+
+		measure("Parse YAML (SafeLoader)", lambda: load_yaml(yaml.SafeLoader))
+		if hasattr(yaml, 'CSafeLoader'):
+			measure("Parse YAML (CSafeLoader)", lambda: load_yaml(yaml.CSafeLoader))
+		rawList = measure("Parse JSON lines", load_json_lines)
+
+	def records():
+		return {queue: [DownloadRecord.from_dict(file) for file in files] for queue, files in rawList.items()}
+
+	def add_batch_files():
+		qm = QueueManager(BenchConfiguration(), logging, BenchDownloaderManager())
+		for queue, files in records().items():
+			qm.addBatchFiles(files, queue)
+
+	def restore():
+		qm = QueueManager(BenchConfiguration(), logging, BenchDownloaderManager())
+		qm.restore(records())
+
+	measure("Install with addBatchFiles", add_batch_files)
+	measure("Install with restore", restore)
+
+
+if __name__ == "__main__":
+	main()
@@ -9,13 +9,14 @@ import sys
 from IUBBaseTools import IUBConfiguration
 
 from DownloaderManager import DownloaderManager
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, request, render_template, jsonify, Response
 from QueueManager import QueueManager
 
 # Details on parameters here:
 #   https://github.com/ytdl-org/youtube-dl/blob/3e4cedf9e8cd3157df2457df7274d0c842421945/youtube_dl/YoutubeDL.py#L137-L312
 
 logName = "Downloader.log"
+keepAliveInterval = 15
 app = Flask(__name__)
 dm: DownloaderManager
 
@@ -58,7 +59,7 @@ def main():
 	port = config_class.get_config('GlobalSettings', 'port')
 	try:
 		logging.debug("Starting service on port: " + str(port))
-		app.jinja_env.globals.update(get_urls=get_urls)
+		app.jinja_env.globals.update(get_urls=get_urls, get_queue_snapshot=dm.get_queue_snapshot)
 		app.run(port=port, host='0.0.0.0', debug=True, use_reloader=False)
 		dm.join()
 		dm.saveHistory()
@@ -102,9 +103,11 @@ def get_urls():
 
 @app.route("/add", methods=['POST'])
 def test1():
-	new_url = request.form.get('new_url')
-	dm.request_download(new_url)
-	print("Added new url [" + new_url + "]")
+	new_url = request.form.get('new_url') or (request.get_json(silent=True) or {}).get('new_url')
+	request_id = dm.request_download(new_url)
+	print("Added new url [" + str(new_url) + "]")
+	if request.is_json:
+		return jsonify({"success": request_id is not None, "request_id": request_id, "queue": QueueManager.DOWNLOAD_RESOLVING})
 	return render_template('base.html')
 	#return escape("Added new url [" + new_url + "]")
 
@@ -121,9 +124,66 @@ def test_home():
 
 @app.route("/status", methods=['GET'])
 def show_progress():
-	urls = get_urls()
+	snapshot = dm.get_queue_snapshot()
 	logging.info("Getting download status")
-	return jsonify(**urls)
+	# The queues did not change since the last poll of this client
+	if snapshot.etag in request.if_none_match:
+		response = app.response_class(status=304)
+	else:
+		response = app.response_class(snapshot.to_json(), mimetype='application/json')
+	response.set_etag(snapshot.etag)
+	return response
+
+
+@app.route("/queue/<name>", methods=['GET'])
+def show_queue_page(name):
+	offset = request.args.get('offset', 0, type=int)
+	limit = request.args.get('limit', 100, type=int)
+	files = dm.get_queue_page(name, max(offset, 0), max(limit, 0))
+	if files is None:
+		return jsonify({"success": False}), 404
+	return jsonify({"queue": name, "offset": offset, "files": files})
+
+
+@app.route("/counts", methods=['GET'])
+def show_queue_counts():
+	return jsonify(dm.get_queue_counts())
+
+
+@app.route("/events", methods=['GET'])
+def stream_events():
+	"""
+	Push the changes of the queues to the client as Server-Sent Events.
+	The client can resume the stream passing the last received event id (Last-Event-ID header or since parameter)
+	:return:
+	"""
+	instanceId = dm.get_queue_snapshot().instanceId
+	lastEventId = request.headers.get('Last-Event-ID') or request.args.get('since', "")
+	since = -1
+	if lastEventId.startswith(instanceId + "-") and lastEventId.split("-")[1].isnumeric():
+		since = int(lastEventId.split("-")[1])
+
+	def generate(since: int):
+		while True:
+			events = dm.get_queue_events(since, keepAliveInterval)
+			if events is None:
+				# The client is too far behind, send the queues kept in memory, the others are read a page at a time
+				snapshot = dm.get_queue_snapshot()
+				since = snapshot.sequence
+				yield "id: " + snapshot.lastEventId + "\nevent: reset\ndata: " + snapshot.to_json() + "\n\n"
+			elif not events:
+				yield ": keep-alive\n\n"
+			else:
+				for sequence, eventType, data in events:
+					yield "id: " + instanceId + "-" + str(sequence) + "\nevent: " + eventType + "\ndata: " + data + "\n\n"
+				since = events[-1][0]
+
+	return Response(generate(since), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@app.route("/metrics", methods=['GET'])
+def show_metrics():
+	return jsonify(dm.get_metrics())
 
 
 @app.route("/supported_sites", methods=['GET'])
@@ -157,8 +217,9 @@ def store_download():
 @app.route("/restore", methods=['POST'])
 def restore_download():
 	restore_url = request.json
-	if dm.restart_download(restore_url):
-		return jsonify({"success": True, "url_restored": restore_url, "old_queue": QueueManager.DOWNLOAD_FAILED, "new_queue": QueueManager.DOWNLOAD_QUEUE})
+	old_queue = dm.restart_download(restore_url)
+	if old_queue:
+		return jsonify({"success": True, "url_restored": restore_url, "old_queue": old_queue, "new_queue": QueueManager.DOWNLOAD_QUEUE})
 	else:
 		return jsonify({"success": False})
 
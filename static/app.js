@@ -51,7 +51,7 @@ function restartDownload(event) {
  */
 function restartDownloadListener(parentElement) {
     let queue = parentElement.dataset.queue;
-    if (queue && queue === "downloadFailed") {
+    if (queue && (queue === "downloadFailed" || queue === "paused")) {
         //Create button
         let button = document.createElement("i");
         button.append(document.createTextNode("🔄"));
@@ -63,6 +63,135 @@ function restartDownloadListener(parentElement) {
     }
 }
 
+/**
+ * Creates the line representing a file in a queue
+ * @param {Object} file The file to represent
+ * @param {string} queue The queue containing the file
+ * @returns {HTMLElement} The line
+ */
+function createLine(file, queue) {
+    let line = document.createElement("p");
+    line.classList.add("queue");
+    line.dataset.url = file.url;
+    line.dataset.queue = queue;
+    let button = document.createElement("i");
+    button.append(document.createTextNode("X"));
+    button.classList.add("action_button", "stop_download");
+    button.addEventListener("click", stopDownload, false);
+    let progress = document.createElement("span");
+    progress.classList.add("progress");
+    let name = document.createElement("span");
+    name.classList.add("name");
+    name.append(document.createTextNode(file.name));
+    let url = document.createElement("span");
+    url.classList.add("url");
+    url.append(document.createTextNode(file.url));
+    line.append(button, progress, name, url);
+    updateProgress(line, file.status);
+    restartDownloadListener(line);
+    return line;
+}
+
+/**
+ * @param {HTMLElement} line The line to update
+ * @param {number} status The download percentage
+ */
+function updateProgress(line, status) {
+    let progress = line.querySelector("span.progress");
+    progress.textContent = (status === undefined || status === null) ? "" : "[" + status + "%] - ";
+}
+
+function findLine(url) {
+    return document.querySelector("p.queue[data-url='" + CSS.escape(url) + "']");
+}
+
+function findQueue(queue) {
+    return document.querySelector("div.queue_list[data-queue='" + queue + "']");
+}
+
+const pageSize = 100;
+
+/**
+ * Rebuild all the queues from a complete snapshot, the queues not included are loaded a page at a time
+ * @param {Object} queues The content of each queue
+ */
+function renderQueues(queues) {
+    for (const list of document.querySelectorAll("div.queue_list")) {
+        const queue = list.dataset.queue;
+        if (queue in queues) {
+            list.replaceChildren(...queues[queue].map(file => createLine(file, queue)));
+        } else {
+            list.replaceChildren();
+            loadQueuePage(list, 0);
+        }
+    }
+}
+
+/**
+ * Append a page of a queue to its list, with a button loading the next one
+ * @param {HTMLElement} list The list of the queue
+ * @param {number} offset The number of files to skip
+ */
+function loadQueuePage(list, offset) {
+    const queue = list.dataset.queue;
+    fetch("/queue/" + encodeURIComponent(queue) + "?offset=" + offset + "&limit=" + pageSize)
+        .then(res => res.json())
+        .then(page => {
+            list.querySelectorAll("p.more").forEach(more => more.remove());
+            list.append(...page.files.filter(file => !findLine(file.url)).map(file => createLine(file, queue)));
+            if (page.files.length === pageSize) {
+                let more = document.createElement("p");
+                more.classList.add("more");
+                more.append(document.createTextNode("Show more"));
+                more.addEventListener("click", () => loadQueuePage(list, offset + pageSize), {once: true});
+                list.append(more);
+            }
+        });
+}
+
+function placeFile(file, queue) {
+    let list = findQueue(queue);
+    let line = findLine(file.url);
+    if (line) {
+        line.remove();
+    }
+    if (list) {
+        const more = list.querySelector("p.more");
+        list.insertBefore(createLine(file, queue), more);
+    }
+}
+
+/**
+ * Follows the changes of the queues pushed by the server
+ */
+function listenQueueEvents() {
+    const content = document.querySelector("section.content");
+    const lastEvent = content ? content.dataset.lastEvent : "";
+    const source = new EventSource("/events?since=" + encodeURIComponent(lastEvent));
+    source.addEventListener("reset", event => renderQueues(JSON.parse(event.data)));
+    source.addEventListener("add", event => {
+        const data = JSON.parse(event.data);
+        placeFile(data.file, data.queue);
+    });
+    source.addEventListener("move", event => {
+        const data = JSON.parse(event.data);
+        placeFile(data.file, data.queue);
+    });
+    source.addEventListener("delete", event => {
+        const line = findLine(JSON.parse(event.data).url);
+        if (line) {
+            line.remove();
+        }
+    });
+    source.addEventListener("progress", event => {
+        const data = JSON.parse(event.data);
+        const line = findLine(data.url);
+        if (line) {
+            updateProgress(line, data.status);
+        }
+    });
+}
+
 window.addEventListener('load', (event) => {
     // Add event listener to all elements
     const lines = document.getElementsByClassName("stop_download");
@@ -74,5 +203,8 @@ window.addEventListener('load', (event) => {
     if (!lines) {
         console.error("No lines found");
     }
+    for (const list of document.querySelectorAll("div.queue_list[data-count]")) {
+        loadQueuePage(list, 0);
+    }
+    listenQueueEvents();
 });
-
@@ -0,0 +1,75 @@
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from DownloadRecord import DownloadRecord
+from DownloaderManager import DownloaderManager
+from IUBBaseTools import IUBConfiguration
+from QueueManager import QueueManager
+from QueueStore import SqliteQueueStore
+
+
+class SqliteBackendTest(unittest.TestCase):
+	"""
+	Start the manager on a database already holding the queues of a previous run
+	"""
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.previousDir = os.getcwd()
+		os.chdir(self.directory.name)
+		self.database = os.path.join(self.directory.name, 'history.db')
+		settingsPath = os.path.join(self.directory.name, 'settings.yml')
+		with open(settingsPath, 'w') as f:
+			yaml.safe_dump({'GlobalSettings': {
+				'logLevel': 'WARNING',
+				'outtmpl': os.path.join(self.directory.name, '%(title)s.%(ext)s'),
+				'maxTotalDownload': 3,
+				'maxDownloadPerHost': 2,
+				'queueBackend': 'sqlite',
+				'databaseFile': self.database
+			}}, f)
+		self.settings = IUBConfiguration(settingsPath, logging)
+
+	def tearDown(self):
+		os.chdir(self.previousDir)
+		self.directory.cleanup()
+
+	def _store_previous_run(self, queues: dict):
+		store = SqliteQueueStore(self.database, QueueManager.ALL_QUEUES, QueueManager.ACTIVE_QUEUES, logging)
+		for queue, urls in queues.items():
+			store.insert_batch([DownloadRecord(url, url, 'youtube.com') for url in urls], queue)
+		store.close()
+
+	def test_reopen_pending_downloads(self):
+		self._store_previous_run({
+			QueueManager.DOWNLOAD_QUEUE: ['https://youtube.com/watch?v=1', 'https://youtube.com/watch?v=2'],
+			QueueManager.DOWNLOAD_COMPLETED: ['https://youtube.com/watch?v=0']
+		})
+		dm = DownloaderManager(self.settings, logging)
+		try:
+			dm.loadDatabase()
+			counts = dm.get_queue_counts()
+			self.assertEqual(counts[QueueManager.DOWNLOAD_QUEUE], 2)
+			self.assertEqual(counts[QueueManager.DOWNLOAD_COMPLETED], 1)
+			self.assertEqual(dm.queueManager.get_next_file().url, 'https://youtube.com/watch?v=1')
+		finally:
+			dm.queueManager.store.close()
+
+	def test_active_download_is_queued_again(self):
+		self._store_previous_run({QueueManager.DOWNLOAD_ACTIVE: ['https://youtube.com/watch?v=3']})
+		dm = DownloaderManager(self.settings, logging)
+		try:
+			dm.loadDatabase()
+			self.assertEqual(dm.queueManager.retrieveFileFromUrl('https://youtube.com/watch?v=3', QueueManager.ALL_QUEUES)[1], QueueManager.DOWNLOAD_QUEUE)
+		finally:
+			dm.queueManager.store.close()
+
+
+if __name__ == "__main__":
+	unittest.main()